@@ -31,12 +31,16 @@ from logger import log
 from settings import sett
 
 import util
+import transport
 import lib.db as db
 
 
 class ActivityMgr(QtCore.QObject):
     sig = QtCore.pyqtSignal()
 
+    columns = ["name", "description", "project_id", "active"]   # copied from server
+    LOOKUP_SIZE = 500       # max activities in each IN (...)
+
     def __init__(self, localdb=None):
         super().__init__()
         self.localdb = localdb
@@ -145,63 +149,99 @@ class ActivityMgr(QtCore.QObject):
         Runs as a separate thread
         """
 
-        # Get list of all activities on server
+        state = util.getSyncState(self.localdb, "activity")
+
+        # Get activities changed since last sync
+        headers = {}
+        if state.etag:
+            headers["If-None-Match"] = state.etag
+        params = {}
+        if state.seq:
+            params["since"] = state.seq
         try:
-            r = requests.get(f"{sett.server_url}/api/activity")
-            srv_activities = r.json()
-            srv_activities = srv_activities["data"]
-        except requests.exceptions.RequestException as err:
+            r = self.transport.get("/api/activity", params=params, headers=headers)
+            if r.status_code == 304:
+                log.debugf(log.DEBUG_ACTIVITYMGR, "No changed activities on server")
+                return
+            r.raise_for_status()
+            srv_data = r.json()
+            srv_activities = srv_data["data"]
+        except (requests.exceptions.RequestException, ValueError) as err:
             log.error(f"Cannot load list of activities from server {err}")
             return
 
+        try:
+            with self.localdb.transaction():
+                self._applyServerActivities(srv_activities)
+                # older servers has no seq, then we get the full list each time
+                util.setSyncSeq(self.localdb, "activity", srv_data.get("seq", 0), etag=r.headers.get("ETag", ""))
+        except db.DbException as err:
+            log.error(f"Cannot store activities in local database {err}")
+            return
+
+        self._loadList()
+        self.sig.emit()
+
+    def _applyServerActivities(self, srv_activities):
+        """
+        Update local activities from the server list
+        Should be called inside a transaction, raises DbException on errors
+        """
+        # find the activities we already have, with one lookup per chunk
+        local_activities = {}   # server _id -> local activity
+        server_ids = [srv_activity["_id"] for srv_activity in srv_activities]
+        for ix in range(0, len(server_ids), self.LOOKUP_SIZE):
+            chunk = server_ids[ix:ix + self.LOOKUP_SIZE]
+            sql = "SELECT * FROM activity WHERE server_id IN (%s)" % ",".join("?" * len(chunk))
+            for local_activity in self.localdb.select_all(sql, chunk):
+                local_activities[local_activity.server_id] = local_activity
+
+        inserts = []
+        updates = []
         for srv_activity in srv_activities:
             srv_activity = AttrDict(srv_activity)
             log.debug(f"Server activity {srv_activity}")
 
-            sql = "SELECT * FROM activity WHERE server_id=?"
-            local_activity = self.localdb.select_one(sql, (srv_activity["_id"],))
+            local_activity = local_activities.get(srv_activity._id)
             if local_activity:
                 # we have the activity locally, check if changed
                 changes = []
-                for attr in ["name", "description", "active"]:
+                for attr in self.columns:
                     if getattr(local_activity, attr) != getattr(srv_activity, attr):
                         changes.append(attr)
                 if changes:
                     tmp = str(srv_activity).replace("\n", " ")
                     log.debugf(log.DEBUG_ACTIVITYMGR, f"Updating local copy of activity, changed columns {changes}, {tmp}")
-                    local_activity.name = srv_activity["name"]
-                    local_activity.server_id = srv_activity["_id"]
-                    local_activity.active = srv_activity["active"]
-                    try:
-                        self.localdb.update("activity", d=local_activity, primary_key="_id")
-                    except db.DbException as err:
-                        log.error(f"Cannot update local activity {err}")
-                        return
+                    d = AttrDict(_id=local_activity._id)
+                    for attr in self.columns:
+                        d[attr] = srv_activity[attr]
+                    updates.append(d)
             else:
                 # new activity
                 log.debugf(log.DEBUG_ACTIVITYMGR, f"New activity '{srv_activity.name}' on server, saving in local database")
-                srv_activity.server_id = srv_activity._id
-                srv_activity._id = -1
-                try:
-                    self.localdb.insert("activity", d=srv_activity, primary_key="_id")
-                except db.DbException as err:
-                    log.error(f"Cannot save new activity in local database {err}")
-                    return
+                d = AttrDict(_id=-1, server_id=srv_activity._id)
+                for attr in self.columns:
+                    d[attr] = srv_activity[attr]
+                inserts.append(d)
 
-        self._loadList()
-        self.sig.emit()
+        if updates:
+            self.localdb.update_many("activity", rows=updates, primary_key="_id")
+        if inserts:
+            self.localdb.insert_many("activity", rows=inserts, primary_key="_id")
 
     def run(self):
         """
         Runs as a separate thread
         """
         log.debugf(log.DEBUG_ACTIVITYMGR, "Starting activitymgr thread")
+        self.transport = transport.Transport()
 
         while True:
             req = self.toThreadQ.get()
             log.debugf(log.DEBUG_ACTIVITYMGR, f"activitymgr, request={req}")
             if req == "quit":
                 log.debugf(log.DEBUG_ACTIVITYMGR, "activitymgr thread stopping")
+                self.transport.close()
                 return
             elif req == "sync":
                 # connect to database, we have a separate connection in this thread to
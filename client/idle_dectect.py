@@ -28,6 +28,8 @@ import platform
 import ctypes
 import ctypes.util
 
+import PyQt5.QtCore as QtCore
+
 
 class WindowsIdleDetect:
 
@@ -134,6 +136,44 @@ def get_idle():
     return idle_detector.get_idle()
 
 
+class IdleMonitor(QtCore.QObject):
+    """
+    Emits idleTimeout when the user has been idle more than timeout seconds
+
+    Instead of checking every second, the next check is scheduled when the
+    timeout at the earliest can be reached, timeout minus the current idle
+    time. An active user is checked about once per timeout period
+    """
+
+    idleTimeout = QtCore.pyqtSignal(int)    # idle seconds
+
+    def __init__(self, timeout, parent=None):
+        super().__init__(parent)
+        self.timeout = timeout
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._check)
+
+    def start(self):
+        self._check()
+
+    def stop(self):
+        self._timer.stop()
+
+    def setTimeout(self, timeout):
+        self.timeout = timeout
+        if self._timer.isActive():
+            self._check()
+
+    def _check(self):
+        idle = get_idle()
+        if idle > self.timeout:
+            self.idleTimeout.emit(int(idle))
+            return
+        delay = self.timeout - idle + 1
+        self._timer.start(int(delay * 1000))
+
+
 if __name__ == "__main__":
     # Module test
     import time
@@ -21,11 +21,68 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import time
 import datetime
 import threading
+import collections
 
 import PyQt5.QtCore as QtCore
-import PyQt5.QtWidgets as QtWidgets
+
+
+class LogModel(QtCore.QAbstractTableModel):
+    """
+    The last maxlen log lines, oldest lines are dropped when new are added
+    """
+
+    headers = ("When", "Thread", "Level", "Message")
+
+    def __init__(self, maxlen=500, parent=None):
+        super().__init__(parent)
+        self.maxlen = maxlen
+        self.lines = collections.deque(maxlen=maxlen)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.lines)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return self.lines[index.row()][index.column()]
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def append(self, lines):
+        """
+        Add lines at the end, with one remove and one insert for all of them
+        """
+        lines = lines[-self.maxlen:]
+        if not lines:
+            return
+        drop = len(self.lines) + len(lines) - self.maxlen
+        if drop > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, drop - 1)
+            for i in range(drop):
+                self.lines.popleft()
+            self.endRemoveRows()
+        first = len(self.lines)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.lines.clear()
+        self.endResetModel()
 
 
 class Log(QtCore.QObject):
@@ -42,6 +99,7 @@ class Log(QtCore.QObject):
     DEBUG_MAINWIN           = 1 << 5
     DEBUG_OPTIONS           = 1 << 6
     DEBUG_SYSTRAY           = 1 << 7
+    DEBUG_TRANSPORT         = 1 << 8
 
     # Setup debug bitmask
     DEBUG_LEVEL = 0
@@ -52,9 +110,14 @@ class Log(QtCore.QObject):
     DEBUG_LEVEL |= DEBUG_MAINWIN     * 1
     DEBUG_LEVEL |= DEBUG_OPTIONS     * 1
     DEBUG_LEVEL |= DEBUG_SYSTRAY     * 1
+    DEBUG_LEVEL |= DEBUG_TRANSPORT   * 0
 
     logTrigger = QtCore.pyqtSignal(int, str, str)
 
+    MAX_LINES = 500         # lines kept in the log window
+    FLUSH_INTERVAL = 100    # ms, new lines are added to the log window this often
+    RESIZE_INTERVAL = 1.0   # seconds, minimum time between column resizes
+
     INFO = 0
     WARNING = 1
     ERROR = 2
@@ -72,29 +135,50 @@ class Log(QtCore.QObject):
 
     def __init__(self):
         super().__init__()
-        self.out = None     # QT Widget for log output
+        self.out = None     # QTableView for log output
+        self.model = None
         self.levels = ["INFO", "WARNING", "ERROR", "DEBUG", "CONSOLE"]
         self.level = self.CONSOLE
         self.logTrigger.connect(self.log)
-        self._lines = []    # temp buffer until we have an output device
-
-    def add_row(self, line):
-        c = self.out.rowCount()
-        self.out.setRowCount(c + 1)
-        self.out.setItem(c, 0, QtWidgets.QTableWidgetItem(line[0]))
-        self.out.setItem(c, 1, QtWidgets.QTableWidgetItem(line[1]))
-        self.out.setItem(c, 2, QtWidgets.QTableWidgetItem(line[2]))
-        self.out.setItem(c, 3, QtWidgets.QTableWidgetItem(line[3]))
-        if c > 500:
-            self.out.removeRow(0)
-        self.out.resizeColumnsToContents()
-        self.out.scrollToBottom()
+        self._lines = []    # lines not yet in the log window
+        self._lastResize = 0
+        self._flushTimer = None
+
+    def _flush(self):
+        """
+        Add buffered lines to the log window, in one batch
+        """
+        if self.out is None or not self._lines:
+            return
+        scrollbar = self.out.verticalScrollBar()
+        atBottom = scrollbar.value() == scrollbar.maximum()
+        self.model.append(self._lines)
+        self._lines = []
+
+        now = time.monotonic()
+        if now - self._lastResize > self.RESIZE_INTERVAL:
+            self._lastResize = now
+            self.out.resizeColumnsToContents()
+        if atBottom:
+            # only follow new lines if the user has not scrolled up
+            self.out.scrollToBottom()
 
     def setOut(self, out):
         self.out = out
-        for line in self._lines:
-            self.add_row(line)
+        self.model = LogModel(maxlen=self.MAX_LINES, parent=self)
+        self.out.setModel(self.model)
+
+        # created here, the QApplication must exist
+        self._flushTimer = QtCore.QTimer(self)
+        self._flushTimer.setSingleShot(True)
+        self._flushTimer.setInterval(self.FLUSH_INTERVAL)
+        self._flushTimer.timeout.connect(self._flush)
+        self._flush()
+
+    def clear(self):
         self._lines = []
+        if self.model is not None:
+            self.model.clear()
 
     def setLevel(self, level):
         if isinstance(level, str):
@@ -105,12 +189,12 @@ class Log(QtCore.QObject):
         if level <= self.level:
             now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             msg = str(msg).replace("\n", ", ")
-            line = [now, threadname, self.levels[level], msg]
+            line = (now, threadname, self.levels[level], msg)
+            self._lines.append(line)
             if self.out is None:
-                self._lines.append(line)
                 print(" ".join(line))
-            else:
-                self.add_row(line)
+            elif not self._flushTimer.isActive():
+                self._flushTimer.start()
 
     def info(self, msg):
         self.logTrigger.emit(self.INFO, threading.current_thread().getName(), msg)
@@ -34,6 +34,7 @@ from logger import log
 from settings import sett
 from activitymgr import ActivityMgr
 from reportmgr import ReportMgr
+from reporttablemodel import ReportTableModel
 
 from common.report import Report
 
@@ -47,6 +48,8 @@ class MyStatusBar:
     def __init__(self, ui):
         self.lblStatusIdle = QtWidgets.QLabel()
         ui.statusBar().addWidget(self.lblStatusIdle)
+        self.lblStatusSync = QtWidgets.QLabel()
+        ui.statusBar().addWidget(self.lblStatusSync)
 
     @property
     def idle(self):
@@ -56,6 +59,14 @@ class MyStatusBar:
     def idle(self, value):
         self.lblStatusIdle.setText(value)
 
+    @property
+    def sync(self):
+        return self.lblStatusSync.text()
+
+    @sync.setter
+    def sync(self, value):
+        self.lblStatusSync.setText(value)
+
 
 class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
 
@@ -116,7 +127,9 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         self._initReports()
         self.init_report_window()
 
+        self.timetracker.setGuiVisible(self.isVisible() and not self.isMinimized())
         self.timetracker.init()
+        self._recoverRunningReports()
 
         self._ReportsSetSelectedDateToday()
 
@@ -134,6 +147,21 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         about.setWindowFlag(QtCore.Qt.WindowContextHelpButtonHint, False)
         about.exec_()
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.timetracker:
+            self.timetracker.setGuiVisible(True)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        if self.timetracker:
+            self.timetracker.setGuiVisible(False)
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QtCore.QEvent.WindowStateChange and self.timetracker:
+            self.timetracker.setGuiVisible(not self.isMinimized())
+
     def closeEvent(self, event):
         if self._closeHandler():
             event.accept()
@@ -149,8 +177,10 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
             msgBox.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
             msgBox.setDefaultButton(QtWidgets.QMessageBox.No)
             response = msgBox.exec_()
-            if response != QtWidgets.QMessageBox.Yes:
+            if response == QtWidgets.QMessageBox.Yes:
                 self.timetracker.setStateInactive()
+            else:
+                self.timetracker.discardReport()
 
         if not sett.runFromIde:
             # do we have unsyncronised local changes?
@@ -160,9 +190,9 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
                 msgBox.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
                 msgBox.setDefaultButton(QtWidgets.QMessageBox.No)
                 response = msgBox.exec_()
-                if response != QtWidgets.QMessageBox.Yes:
-                    self.reportmgr.sync()
-                    # todo, wait for sync done
+                if response == QtWidgets.QMessageBox.Yes:
+                    if not self._closeSync():
+                        log.error("Sync with server failed, local changes are sent next time ErgoTime is started")
 
         self._saveWindowPosition()
         self.activitymgr.stop()
@@ -171,6 +201,60 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         sett.sync()
         QtWidgets.QApplication.exit(0)
 
+    def _closeSync(self):
+        """
+        Sync reports before quitting, with a progress dialog the user can cancel
+        Waits at most 2 * networkTimeout
+        Returns True if the sync was successful
+        """
+        progress = QtWidgets.QProgressDialog("Sending reports to server...", "Cancel", 0, 0, self)
+        progress.setWindowModality(QtCore.Qt.WindowModal)
+        progress.setMinimumDuration(0)
+
+        loop = QtCore.QEventLoop()
+
+        def syncDone(ok):
+            if not self.reportmgr.syncPending():
+                loop.quit()
+
+        timer = QtCore.QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(loop.quit)
+        progress.canceled.connect(loop.quit)
+        self.reportmgr.syncDone.connect(syncDone)
+
+        self.reportmgr.sync(now=True)
+        progress.show()
+        timer.start(sett.networkTimeout * 2 * 1000)
+        loop.exec_()
+
+        timer.stop()
+        self.reportmgr.syncDone.disconnect(syncDone)
+        progress.close()
+        if self.reportmgr.syncPending():
+            return False    # canceled or timeout
+        return self.reportmgr.waitSync(timeout=0)
+
+    def _recoverRunningReports(self):
+        """
+        Reports still running in local database, ErgoTime was not stopped correctly
+        Ask if they should be saved, ending at the last checkpoint
+        """
+        for report in self.reportmgr.getOpenReports():
+            activity = self.activitymgr.get(report.activityid)
+            name = activity.name if activity else "unknown activity"
+            msgBox = QtWidgets.QMessageBox(parent=self)
+            msgBox.setText(f"ErgoTime was not stopped correctly, a report for {name} was running "
+                           f"from {report.start} to {report.stop}. Do you want to save this as a report?")
+            msgBox.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
+            msgBox.setDefaultButton(QtWidgets.QMessageBox.Yes)
+            response = msgBox.exec_()
+            if response == QtWidgets.QMessageBox.Yes:
+                log.info(f"Saving report running when ErgoTime stopped, {report.start} - {report.stop}")
+                self.reportmgr.store(report)
+            else:
+                self.reportmgr.discard(report)
+
     def _saveWindowPosition(self):
         """
         save the current windows position & size in settings
@@ -218,7 +302,7 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         self.actionActivitySync.triggered.connect(self.activitymgr.sync)
 
         # Report, Sync
-        self.actionReportSync.triggered.connect(self.reportmgr.sync)
+        self.actionReportSync.triggered.connect(self._reportsSyncNow)
 
         # Help, about
         self.actionAbout.triggered.connect(self.about)
@@ -232,18 +316,13 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
     def _initLog(self):
         self.log_table.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.log_table.customContextMenuRequested.connect(self.handleLogMenu)
-        self.log_table.clear()
-        self.log_table.setColumnCount(4)
-        self.log_table.setRowCount(0)
-        self.log_table.setHorizontalHeaderLabels(["When", "Thread", "Level", "Message"])
 
     def handleLogMenu(self, pos):
         menu = QtWidgets.QMenu(self)
         clearAction = menu.addAction("Clear")
         action = menu.exec_(QtGui.QCursor.pos())
         if action == clearAction:
-            self.log_table.clearContents()
-            self.log_table.setRowCount(0)
+            log.clear()
             log.debugf(log.DEBUG_MAINWIN, "Log cleared()")
 
     # ########################################################################
@@ -356,6 +435,7 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
             self.report.comment = self.txtCurrentComment.toPlainText()
 
             self.timetracker.report = self.report
+            self.timetracker.reportChanged()
 
     # ########################################################################
     #
@@ -365,7 +445,8 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
 
     def _initReports(self):
         # Toolbar
-        self.btnReportSync.clicked.connect(self.reportmgr.sync)
+        self.btnReportSync.clicked.connect(self._reportsSyncNow)
+        self.reportmgr.syncDone.connect(self._reportsSyncDone)
         self.chkReportSyncAuto.stateChanged.connect(self.reportmgr.setAutosync)
 
         self.btnSetSelectedDatePrev.clicked.connect(self._ReportsSetSelectedDatePrev)
@@ -375,21 +456,54 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         self.selectedDate.dateChanged.connect(self._ReportsUpdateWeekday)
 
         # Table
+        self.reportModel = ReportTableModel(activitymgr=self.activitymgr, parent=self)
+        self._reportsResizePending = False
+        self.reportModel.modelReset.connect(self._reportsTableResize)
+        self.reportModel.rowsInserted.connect(self._reportsTableResize)
         t = self.tableReports   # less typing
+        t.setModel(self.reportModel)
         t.clearSelection()
-        t.setColumnCount(7)
-        t.setRowCount(1)
-        t.setHorizontalHeaderLabels(("Activity", "Project", "Start", "Stop", "Len", "Flags", "Comment"))
         t.verticalHeader().setVisible(False)
+        t.horizontalHeader().setResizeContentsPrecision(100)    # only look at first rows when resizing
         t.clicked.connect(self.report_edit)
 
         self.reportmgr.sig.connect(self._reportsTableUpdated)
 
-    def _reportsTableSet(self, table, row, col, value, userdata=None):
-        table_item = QtWidgets.QTableWidgetItem(value)
-        if userdata is not None:
-            table_item.setData(QtCore.Qt.UserRole, userdata)
-        table.setItem(row, col, table_item)
+    def _reportsTableResize(self, *args):
+        """
+        Resize columns once, after all changes, instead of on every change
+        """
+        if self._reportsResizePending:
+            return
+        self._reportsResizePending = True
+
+        def resize():
+            self._reportsResizePending = False
+            self.tableReports.resizeColumnsToContents()
+        QtCore.QTimer.singleShot(0, resize)
+
+    def _reportsSyncNow(self):
+        """
+        Sync button or menu, disabled until the sync has finished
+        """
+        self.btnReportSync.setEnabled(False)
+        self.actionReportSync.setEnabled(False)
+        self._myStatusBar.sync = "Syncing reports"
+        self.reportmgr.syncNow()
+
+    def _reportsSyncDone(self, ok):
+        """
+        Called when reportmgr has finished a sync, also autosync and periodic sync
+        """
+        if self.reportmgr.syncPending():
+            return
+        self.btnReportSync.setEnabled(True)
+        self.actionReportSync.setEnabled(True)
+        now = datetime.datetime.now().strftime("%H:%M")
+        if ok:
+            self._myStatusBar.sync = f"Reports synced {now}"
+        else:
+            self._myStatusBar.sync = f"Report sync failed {now}"
 
     def _reportsTableUpdated(self):
         """
@@ -398,88 +512,7 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         if not self.reportmgr:
             return  # not initialized yet
         d = self.selectedDate.date().toPyDate()
-        self.rlist = self.reportmgr.getList(d)
-        t = self.tableReports   # less typing
-        t.clearSelection()
-        t.setRowCount(len(self.rlist) + 1)
-        row = 0
-        totalLen = 0
-        for r in self.rlist:
-            col = 0
-
-            a = self.activitymgr.get(r.activityid)
-            if a is not None:
-                self._reportsTableSet(t, row, col, a.name, r._id)
-            else:
-                self._reportsTableSet(t, row, col, "Unknown", r._id)
-            col += 1
-
-            # self._reportsTableSet(t, row, col, p.name, p._id)
-            self._reportsTableSet(t, row, col, "?")
-            col += 1
-
-            try:
-                tmp = r.start.strftime("%H:%M")
-            except AttributeError:
-                tmp = "None"
-            self._reportsTableSet(t, row, col, tmp)
-            col += 1
-
-            try:
-                tmp = r.stop.strftime("%H:%M")
-            except AttributeError:
-                tmp = "None"
-            self._reportsTableSet(t, row, col, tmp)
-            col += 1
-
-            if r.start is not None and r.stop is not None:
-                l = (r.stop - r.start).total_seconds() / 60
-                totalLen += l
-                tmp = f"{l//60:.0f}:{l%60:02.0f}"
-            else:
-                tmp = "None"
-            self._reportsTableSet(t, row, col, tmp)
-            col += 1
-
-            s = ""
-            if r.server_id is not None and r.server_id > -1:
-                s += f"on server({r.server_id})"
-            if r.updated:
-                s += " updated"
-            if r.deleted:
-                s += " remove"
-            self._reportsTableSet(t, row, col, s)
-            col += 1
-
-            self._reportsTableSet(t, row, col, r.comment)
-            col += 1
-
-            row += 1
-
-        col = 0
-
-        self._reportsTableSet(t, row, col, "Total")
-        col += 1
-
-        self._reportsTableSet(t, row, col, "")
-        col += 1
-
-        self._reportsTableSet(t, row, col, "")
-        col += 1
-
-        self._reportsTableSet(t, row, col, "")
-        col += 1
-
-        self._reportsTableSet(t, row, col, f"{totalLen // 60:.0f}:{totalLen % 60:02.0f}")
-        col += 1
-
-        self._reportsTableSet(t, row, col, "")
-        col += 1
-
-        self._reportsTableSet(t, row, col, "")
-        col += 1
-
-        t.resizeColumnsToContents()
+        self.reportModel.setReports(self.reportmgr.getList(d))
 
     def _ReportsSetCurrentDate(self, d):
         """
@@ -508,10 +541,9 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         self._reportsTableUpdated()
 
     def _ReportsGetSelectedReportId(self):
-        row = self.tableReports.currentRow()
-        if row:
-            _id = self.tableReports.item(row, 0).data(QtCore.Qt.UserRole)
-            return _id
+        index = self.tableReports.currentIndex()
+        if index.isValid():
+            return self.reportModel.reportId(index.row())
         return None
 
     def _getNewReport(self):
@@ -551,21 +583,18 @@ class MainWin(QtWidgets.QMainWindow, main_win.Ui_Main):
         Open the report detail window, for editing an existing report
         Called from double-click in table, or edit button
         """
-        row = self.tableReports.currentRow()
-        row = self.tableReports.item(row, 0)
-        if row:
-            _id = row.data(QtCore.Qt.UserRole)
-            if _id is not None and _id >= 0:
-                report = self.reportmgr.get(_id)
-                if report:
-                    a = report_main.Report_Win(self,
-                                               activityMgr=self.activitymgr,
-                                               reportMgr=self.reportmgr,
-                                               report=report)
-                    a.setWindowFlag(QtCore.Qt.WindowContextHelpButtonHint, False)
-                    a.exec_()
-                    return
-                log.error(f"Can't find report {_id} in local database")
+        _id = self._ReportsGetSelectedReportId()
+        if _id is not None and _id >= 0:
+            report = self.reportmgr.get(_id)
+            if report:
+                a = report_main.Report_Win(self,
+                                           activityMgr=self.activitymgr,
+                                           reportMgr=self.reportmgr,
+                                           report=report)
+                a.setWindowFlag(QtCore.Qt.WindowContextHelpButtonHint, False)
+                a.exec_()
+                return
+            log.error(f"Can't find report {_id} in local database")
 
     def report_delete(self):
         """
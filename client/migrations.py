@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Schema migrations for the local database
+
+Only add new migrations to the end of the list, with a higher version.
+Databases created before the migrations existed already have the tables,
+so the first migrations must be safe to run on them
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from lib.migrate import Migration
+
+
+def _create_tables(db):
+    sql = "CREATE TABLE IF NOT EXISTS report ("
+    sql += "  _id         INTEGER PRIMARY KEY, "
+    sql += "  user_id     INT  NOT NULL default -1, "
+    sql += "  activityid  INT  NOT NULL default -1, "
+    sql += "  start       TIMESTAMP NOT NULL, "
+    sql += "  stop        TIMESTAMP NOT NULL, "
+    sql += "  comment     TEXT NOT NULL default '', "
+
+    sql += "  modified    TIMESTAMP NOT NULL, "
+    sql += "  seq         INT  NOT NULL default -1, "
+    sql += "  deleted     INT  NOT NULL default  0, "
+
+    sql += "  server_id   INT  NOT NULL default -1, "
+    sql += "  updated     INT  NOT NULL default -1 "
+    sql += ");"
+    db.execute(sql)
+
+    sql = "CREATE TABLE IF NOT EXISTS activity ("
+    sql += "  _id         INTEGER PRIMARY KEY, "
+    sql += "  name        TEXT NOT NULL default '', "
+    sql += "  description TEXT NOT NULL default '', "
+    sql += "  project_id  INT  NOT NULL default -1, "
+    sql += "  active      INT  NOT NULL default  0, "
+    sql += "  server_id   INT  NOT NULL default -1 "
+    sql += ");"
+    db.execute(sql)
+
+    sql = "CREATE TABLE IF NOT EXISTS project ("
+    sql += "  _id         INTEGER PRIMARY KEY, "
+    sql += "  activity_id INT  NOT NULL default -1, "
+    sql += "  name        TEXT NOT NULL default '', "
+    sql += "  costcenter  TEXT NOT NULL default '', "
+    sql += "  active      INT  NOT NULL default  0 "
+    sql += ");"
+    db.execute(sql)
+
+
+migrations = [
+    Migration(1, "Create tables", sqlite=_create_tables),
+
+    Migration(2, "Indexes for sync and report list", sqlite=[
+        "CREATE INDEX IF NOT EXISTS report_server_id ON report (server_id)",
+        "CREATE INDEX IF NOT EXISTS report_start ON report (start)",
+        "CREATE INDEX IF NOT EXISTS report_seq ON report (seq)",
+        "CREATE INDEX IF NOT EXISTS report_deleted ON report (server_id) WHERE deleted=1",
+        "CREATE INDEX IF NOT EXISTS report_updated ON report (server_id) WHERE updated != 0",
+        "CREATE INDEX IF NOT EXISTS activity_server_id ON activity (server_id)",
+    ]),
+
+    Migration(3, "Sync watermark per entity", sqlite=[
+        "CREATE TABLE IF NOT EXISTS sync_state ("
+        "  entity      TEXT PRIMARY KEY, "
+        "  seq         INT  NOT NULL default 0, "
+        "  synced      TIMESTAMP"
+        ")",
+        # continue from where the old MAX(seq) based sync was
+        "INSERT OR IGNORE INTO sync_state (entity, seq) SELECT 'report', COALESCE(MAX(seq), 0) FROM report",
+        "INSERT OR IGNORE INTO sync_state (entity, seq) VALUES ('activity', 0)",
+    ]),
+
+    Migration(4, "Outbox, journal of local changes to send to server", sqlite=[
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "  _id         INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "  report_id   INT  NOT NULL, "
+        "  server_id   INT  NOT NULL default -1, "
+        "  op          TEXT NOT NULL, "
+        "  created     TIMESTAMP NOT NULL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS outbox_report_id ON outbox (report_id)",
+        # changes not yet sent, from the flags used before the outbox
+        "INSERT INTO outbox (report_id, server_id, op, created)"
+        " SELECT _id, server_id, 'delete', datetime('now') FROM report WHERE deleted=1 AND server_id >= 0",
+        "INSERT INTO outbox (report_id, server_id, op, created)"
+        " SELECT _id, server_id, 'store', datetime('now') FROM report"
+        " WHERE deleted=0 AND (server_id < 0 OR (updated != 0 AND updated IS NOT NULL))",
+    ]),
+
+    Migration(5, "ETag of last activity list from server", sqlite=[
+        "ALTER TABLE sync_state ADD COLUMN etag TEXT NOT NULL default ''",
+    ]),
+
+    Migration(6, "Checkpoint of running report", sqlite=[
+        "ALTER TABLE report ADD COLUMN running INT NOT NULL default 0",
+        "CREATE INDEX IF NOT EXISTS report_running ON report (_id) WHERE running=1",
+    ]),
+]
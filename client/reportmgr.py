@@ -19,8 +19,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import time
 import datetime
-import queue
+import collections
 import threading
 import random
 import requests
@@ -32,11 +33,30 @@ from logger import log
 from settings import sett
 
 import util
+import transport
 import lib.db as db
 
 
+def _reportDay(value):
+    """
+    Returns the date of a report start, a datetime, date or string from server
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
 class ReportMgr(QtCore.QObject):
     sig = QtCore.pyqtSignal()
+    syncDone = QtCore.pyqtSignal(bool)     # emitted after each sync, True if successful
+
+    SYNC_PAGE_SIZE = 100    # number of reports in each page from server
+    SYNC_MAXAGE = 180       # days, only sync reports modified after this
+    SYNC_LOOKUP_SIZE = 500  # max reports in each IN (...), sqlite limits number of parameters
+    CACHE_DAYS = 14         # number of days kept in the report cache
+    PREFETCH_DAYS = 1       # days before and after the shown day, loaded in the background
 
     def __init__(self, localdb=None):
         super().__init__()
@@ -44,8 +64,22 @@ class ReportMgr(QtCore.QObject):
 
         self.periodicsync_timer = None
         self._autosync = False
-        self.reports = []   # local cache for todays reports
-        self.toThreadQ = queue.Queue()
+
+        # cache of reports per day, shared with the thread, least recently used day first
+        self._cacheLock = threading.Lock()
+        self._days = collections.OrderedDict()  # date -> list of reports
+        self._byId = {}                         # _id -> report, for the reports in _days
+        self._cacheGen = 0                      # incremented on each invalidation
+
+        # sync scheduler, shared with the thread
+        self._cond = threading.Condition()
+        self._syncDue = None        # monotonic time when the requested sync should start
+        self._requested = 0         # number of sync requests
+        self._completed = 0         # number of requests handled by a finished sync
+        self._syncResult = True     # result of last finished sync
+        self._prefetchQ = []        # days for the thread to load into the cache
+        self._quit = False
+
         self.t = threading.Thread(target=self.runThread)
         self.t.setName("ReportMgr")
         self.t.daemon = True
@@ -96,9 +130,10 @@ class ReportMgr(QtCore.QObject):
         self.sig.emit()
 
     def get(self, _id):
-        for report in self.reports:
-            if report._id == _id:
-                return report
+        with self._cacheLock:
+            report = self._byId.get(_id)
+        if report is not None:
+            return report
         try:
             sql = "SELECT * FROM report WHERE _id=?"
             report = self.localdb.select_one(sql, (_id,))
@@ -108,35 +143,168 @@ class ReportMgr(QtCore.QObject):
         return report
 
     def getList(self, start=None):
-        stop = start + datetime.timedelta(days=1)
-        try:
-            sql = "SELECT * FROM report WHERE start >= ? AND start < ? ORDER BY start"
-            reports = self.localdb.select_all(sql, (start, stop))
-            self.reports.clear()
-            for r in reports:
-                self.reports.append(r)
-        except db.DbException as err:
-            log.error(f"Cannot load list of reports from local database {err}")
+        """
+        Returns list of reports for the day start, from the cache if possible
+        The days around it are loaded into the cache in the background
+        """
+        day = _reportDay(start)
+        with self._cacheLock:
+            reports = self._days.get(day)
+            if reports is not None:
+                self._days.move_to_end(day)
+            gen = self._cacheGen
+        if reports is None:
+            try:
+                reports = self._loadDay(self.localdb, day)
+            except db.DbException as err:
+                log.error(f"Cannot load list of reports from local database {err}")
+                return []
+            self._cachePut(day, reports, gen)
+        self._prefetch(day)
+        return reports
+
+    def _loadDay(self, conn, day):
+        sql = "SELECT * FROM report WHERE start >= ? AND start < ? AND running=0 ORDER BY start"
+        return conn.select_all(sql, (day, day + datetime.timedelta(days=1)))
+
+    def _cachePut(self, day, reports, gen):
+        """
+        Add the reports for a day to the cache, unless the cache has been
+        invalidated since they were loaded
+        """
+        with self._cacheLock:
+            if gen != self._cacheGen:
+                return
+            self._cacheDrop(day)
+            self._days[day] = reports
+            for report in reports:
+                self._byId[report._id] = report
+            while len(self._days) > self.CACHE_DAYS:
+                self._cacheDrop(next(iter(self._days)))
+
+    def _cacheDrop(self, day):
+        """
+        Remove a day from the cache, call with _cacheLock held
+        """
+        for report in self._days.pop(day, []):
+            if self._byId.get(report._id) is report:
+                del self._byId[report._id]
+
+    def invalidate(self, days):
+        """
+        Remove days from the cache, they are loaded again on next getList()
+        Call after the changes are committed
+        """
+        with self._cacheLock:
+            self._cacheGen += 1
+            for day in days:
+                self._cacheDrop(day)
 
-        return self.reports
+    def _prefetch(self, day):
+        """
+        Ask the thread to load the days around day into the cache
+        """
+        days = []
+        with self._cacheLock:
+            for delta in range(1, self.PREFETCH_DAYS + 1):
+                for d in (day - datetime.timedelta(days=delta), day + datetime.timedelta(days=delta)):
+                    if d not in self._days:
+                        days.append(d)
+        if days:
+            with self._cond:
+                self._prefetchQ += days
+                self._cond.notify()
 
     def getUnsyncronisedCount(self):
         """
         Count number of reports in local database that is not syncronised with server
         """
-        sql = "SELECT count(*) FROM report WHERE server_id < 0"
+        sql = "SELECT count(DISTINCT report_id) FROM outbox"
         unsync_reports_count = self.localdb.count(sql)
         return unsync_reports_count
 
-    def store(self, report):
+    def _journal(self, localdb, report, op):
+        """
+        Append a local change to the outbox, sync sends it to the server
+        Call in the same transaction as the change
+        """
+        entry = {
+            "report_id": report._id,
+            "server_id": report.server_id if report.server_id is not None else -1,
+            "op": op,
+            "created": datetime.datetime.now(),
+        }
+        localdb.insert("outbox", d=entry, primary_key="_id")
+
+    def getOpenReports(self):
+        """
+        Returns list of reports still marked as running, left by a crash
+        """
+        try:
+            sql = "SELECT * FROM report WHERE running=1 ORDER BY start"
+            return self.localdb.select_all(sql)
+        except db.DbException as err:
+            log.error(f"Cannot load running reports from local database {err}")
+        return []
+
+    def checkpoint(self, report):
+        """
+        Save the running report in local database, so it is not lost on a crash
+
+        First checkpoint inserts the report marked as running, the following
+        only update start, stop, activity and comment. Running reports are not in
+        the outbox, and not shown in the list of reports. store() clears the
+        running flag and journals the report
+        Returns True if successful
+        """
+        report.running = 1
         try:
             if report._id < 0:
                 self.localdb.insert("report", d=report, primary_key="_id")
             else:
-                self.localdb.update("report", d=report, primary_key="_id")
+                d = {
+                    "_id": report._id,
+                    "activityid": report.activityid,
+                    "comment": report.comment,
+                    "start": report.start,
+                    "stop": report.stop,
+                }
+                self.localdb.update("report", d=d, primary_key="_id")
+        except db.DbException as err:
+            log.error(f"Cannot checkpoint running report in local database {err}")
+            return False
+        return True
+
+    def discard(self, report):
+        """
+        Remove a running report, it was never stored or sent to server
+        """
+        if report._id < 0:
+            return
+        try:
+            sql = "DELETE FROM report WHERE _id=? AND running=1"
+            self.localdb.delete(sql, (report._id,))
+        except db.DbException as err:
+            log.error(f"Cannot remove running report from local database {err}")
+
+    def store(self, report):
+        report.running = 0
+        days = {_reportDay(report.start)}
+        try:
+            with self.localdb.transaction():
+                if report._id < 0:
+                    self.localdb.insert("report", d=report, primary_key="_id")
+                else:
+                    # the report may have been moved from another day
+                    old = self.localdb.select_one("SELECT start FROM report WHERE _id=?", (report._id,))
+                    if old is not None:
+                        days.add(_reportDay(old.start))
+                    self.localdb.update("report", d=report, primary_key="_id")
+                self._journal(self.localdb, report, "store")
         except db.DbException as err:
             log.error(f"Cannot store report in local database {err}")
             return False
+        self.invalidate(days)
         self.sig.emit()
         if self._autosync:
             self.sync()
@@ -148,15 +316,19 @@ class ReportMgr(QtCore.QObject):
         """
         ret = False
         try:
-            if report.server_id is not None and report.server_id >= 0:
-                # Report exist on server, mark for removal - next sync will remove the row
-                report.deleted = 1
-                self.localdb.update("report", d=report, primary_key="_id")
-            else:
-                # Report does not exist on server, can be removed directly
-                sql = "DELETE FROM report WHERE _id=?"
-                self.localdb.delete(sql, (report._id,))
+            with self.localdb.transaction():
+                if report.server_id is not None and report.server_id >= 0:
+                    # Report exist on server, mark for removal - next sync will remove the row
+                    report.deleted = 1
+                    self.localdb.update("report", d=report, primary_key="_id")
+                else:
+                    # Report does not exist on server, can be removed directly
+                    sql = "DELETE FROM report WHERE _id=?"
+                    self.localdb.delete(sql, (report._id,))
+                # journal also when not on server, a sync may be creating it right now
+                self._journal(self.localdb, report, "delete")
             ret = True
+            self.invalidate([_reportDay(report.start)])
             self.sig.emit()
             if self._autosync:
                 self.sync()
@@ -169,16 +341,65 @@ class ReportMgr(QtCore.QObject):
         if self._autosync:
             self.sync()
 
-    def sync(self):
+    def sync(self, now=False):
         """
         Sync the local database with the one on the server
+
+        Requests made before the sync starts collapse into one sync. The
+        sync starts sett.report_sync_debounce seconds after the first
+        request, so a burst of edits is sent together. With now=True it
+        starts directly
+        """
+        with self._cond:
+            due = time.monotonic()
+            if not now:
+                due += sett.report_sync_debounce
+            if self._syncDue is None or due < self._syncDue:
+                self._syncDue = due
+            self._requested += 1
+            self._cond.notify()
+
+    def syncNow(self):
+        """
+        Slot for the sync button and menu
+        """
+        self.sync(now=True)
+
+    def waitSync(self, timeout=None):
+        """
+        Wait until all syncs requested before this call have finished
+        Returns True if the last sync was successful, False on error or timeout
+        """
+        with self._cond:
+            target = self._requested
+            if timeout is not None:
+                end = time.monotonic() + timeout
+            while self._completed < target:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._syncResult
+
+    def syncPending(self):
         """
-        self.toThreadQ.put(["sync"])
+        Returns True if a requested sync has not finished yet
+        """
+        with self._cond:
+            return self._completed < self._requested
 
     def stop(self):
+        """
+        Stop the thread, a requested sync is done first
+        """
         if self.periodicsync_timer and self.periodicsync_timer.is_alive():
             self.periodicsync_timer.cancel()
-        self.toThreadQ.put(["quit"])
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
 
 ##############################################################################
 #
@@ -186,44 +407,55 @@ class ReportMgr(QtCore.QObject):
 #
 ##############################################################################
 
+    def _jsonReport(self, report):
+        """
+        Convert a report from local database to something that can be sent as json
+        """
+        d = {}
+        for key, value in report.items():
+            if isinstance(value, datetime.datetime):
+                value = value.strftime("%Y-%m-%d %H:%M:%S")
+            d[key] = value
+        return d
+
     def _do_sync(self):
         """
-Sync the database on the server and local database, for a specific date
+Returns True if successful
+
+Sync the database on the server and local database
 
 psql has a trigger, if a report is inserted or updated the column "seq" is
 updated from a sequence. It is then easy to find out what has changed
 after last sync
 
-the trigger is configured like this
-    create sequence report_seq;
-
-    create or replace function update_modified_seq()
-    returns trigger as $$
-    begin
-       new.seq = nextval("report_seq");
-       return new;
-    end;
-    $$ language "plpgsql";
-
-    update report set seq = 0 where seq is null;
-    create trigger insert_customer_seq before insert on report for each row execute procedure update_modified_seq();
-    create trigger update_customer_seq before update on report for each row execute procedure update_modified_seq();
+the sequence and trigger are created by the server migrations, server/migrations.py
 
 
  No reports can be locked when sync starts, and no locking is allowed during sync
 
- 1. Send delete request to server for reports being marked for deletion
-    if failure -> stop, otherwise delete flag will be lost further down by the sync
-
- 2. Send new reports to server
-    if failure -> stop, otherwise the entries will be removed further down by the sync
-
- 3. Send updated reports to server
-    if failure -> stop, otherwise changes will be lost further down by the sync
-
- Note: 1-3 could potentially be done in one step
- 5. Request from server all reports with seq > max_seq and modified > first sync date
- 6. For each received report
+ 1. Collect all local changes from the outbox, and max_seq, the highest server
+    seq stored locally, from the sync_state table
+    store() and remove() appends to the outbox, in the same transaction as the
+    change. Several changes to the same report are coalesced to one of
+      reports marked for deletion
+      new reports, not yet on server
+      updated reports
+
+ 2. Send all changes to the server in one request, /api/report/sync
+    The server stores them in one transaction, and returns the server _id for
+    the new reports together with the first page of reports with
+    seq > max_seq and modified > first sync date
+    if failure -> stop, the local changes are kept and sent again on next sync
+    if nothing was sent and nothing received, stop, nothing has changed
+
+ 3. Store the server _id on the new reports, remove the sent entries from the
+    outbox, and clear the updated flag on reports with no newer changes.
+    Reports with newer changes are not replaced by the server copy
+
+ 4. If the server says has_more, get the rest with /api/report/sync/<next_seq>
+    as newline delimited json, and store it one page at a time while it is received
+
+ 5. For each received report
       if report in local database:
          if report is marked deleted
             remove from local database
@@ -231,190 +463,242 @@ the trigger is configured like this
             update report in local database
       else
          insert report in local database
+    The highest seq in the page is saved in sync_state, in the same transaction
 
 """
-        reportapi = f"{sett.server_url}/api/report"
-        log.debugf(log.DEBUG_REPORTMGR, "Sync() Send deleted reports to server")
-        try:
-            sql = "SELECT * FROM report WHERE deleted=1"
-            data = self.thread_db.select_all(sql)
-        except db.DbException as err:
-            log.error(f"  Can't load reports marked for deletion from local database {err}")
-            return
-        for report in data:
-            log.debugf(log.DEBUG_REPORTMGR, f"  Delete report on server {report}")
-
-            report._id = report.server_id   # use server _id
-            report.updated = 0
-            try:
-                url = f"{reportapi}/{report._id}"
-                r = requests.put(url, data=report)
-            except requests.exceptions.RequestException as err:
-                log.error(f"  Can't update report on server {err}")
-                return
+        reportapi = "/api/report"
 
-        log.debugf(log.DEBUG_REPORTMGR, "Sync() Send new reports to server")
+        log.debugf(log.DEBUG_REPORTMGR, "Sync() Collect local changes")
         try:
-            sql = "SELECT * FROM report WHERE server_id < 0"
-            data = self.thread_db.select_all(sql)
-        except db.DbException as err:
-            log.error(f"  Can't load new reports from local database {err}")
-            return
-        for local_report in data:
-            log.debugf(log.DEBUG_REPORTMGR, f"  Sending new report to server {local_report}")
-            _id = local_report._id
-            local_report._id = -1
-            try:
-                url = reportapi
-                r = requests.post(url, data=local_report)
-                srv_data = r.json()
-                print("srv_data", srv_data)
-                srv_data = AttrDict(srv_data)
-            except requests.exceptions.RequestException as err:
-                log.error(f"  Can't send new report to server {err}")
-                return
-            local_report.server_id = srv_data._id
-            local_report._id = _id
-            try:
-                self.thread_db.update("report", d=local_report, primary_key="_id")
-            except db.DbException as err:
-                log.error(f"  Can't update report in local database {err}")
-                return
+            with self.thread_db.transaction():
+                # first, get the highest server seq we have stored, anything higher than this
+                # we don't have locally
+                local_max_seq = util.getSyncSeq(self.thread_db, "report")
 
-        # todo: load report from server to see if it is changed first
+                entries = self.thread_db.select_all("SELECT * FROM outbox ORDER BY _id")
+                new_reports, updated_reports, deleted_ids = self._collectOutbox(entries)
+        except db.DbException as err:
+            log.error(f"  Can't load changed reports from local database {err}")
+            return False
 
-        log.debugf(log.DEBUG_REPORTMGR, "Sync() Send updated reports To server")
+        log.debugf(log.DEBUG_REPORTMGR, f"Sync() Send {len(new_reports)} new, {len(updated_reports)} updated, "
+                                        f"{len(deleted_ids)} deleted reports to server")
+        payload = {
+            "seq": local_max_seq,
+            "maxage": self.SYNC_MAXAGE,
+            "limit": self.SYNC_PAGE_SIZE,
+            "create": [self._jsonReport(r) for r in new_reports],
+            "update": [self._jsonReport(r) for r in updated_reports],
+            "delete": deleted_ids,
+        }
         try:
-            sql = "SELECT * FROM report WHERE updated != 0 AND updated IS NOT NULL"
-            local_reports = self.thread_db.select_all(sql)
-        except db.DbException as err:
-            log.error(f"  Cannot load updated reports from local database, {err}")
-            return
-        for local_report in local_reports:
-            log.debugf(log.DEBUG_REPORTMGR, f"  Updating report on server {local_report}")
-            local_report._id = local_report.server_id
-            local_report.updated = 0
-            try:
-                r = requests.put(url=f"{reportapi}/{local_report._id}", data=local_report)
-            except requests.exceptions.RequestException as err:
-                log.error(f"  Cannot send new report to server, {err}")
-                return
-            try:
-                self.thread_db.update("report", d=local_report, primary_key="_id")
-            except db.DbException as err:
-                log.error(f"  Error storing updated report in local database {err}")
-                return
+            r = self.transport.post(f"{reportapi}/sync", json_data=payload)
+            r.raise_for_status()
+            srv_data = AttrDict(r.json())
+        except (requests.exceptions.RequestException, ValueError) as err:
+            log.error(f"  Can't sync reports with server {err}")
+            return False
 
-        log.debugf(log.DEBUG_REPORTMGR, "Sync() Get new/updated reports from server")
+        if not (entries or srv_data.data):
+            log.debugf(log.DEBUG_REPORTMGR, "Sync() Nothing changed, locally or on server")
+            return True
 
-        # first, get highest seq number from local database, anything higher than this
-        # we don't have locally
+        log.debugf(log.DEBUG_REPORTMGR, "Sync() Get new/updated reports from server")
+        days = set()        # days with changed reports, removed from cache when committed
         try:
-            sql = "SELECT MAX(seq) FROM report"
-            local_data = self.thread_db.select_one(sql)
+            with self.thread_db.transaction():
+                if entries:
+                    self._ackOutbox(entries[-1]._id, srv_data.created, new_reports + updated_reports, days)
+                max_seq = self._applyServerReports(srv_data.data, local_max_seq, days)
+                util.setSyncSeq(self.thread_db, "report", max_seq)
         except db.DbException as err:
-            log.error(f"  Error getting highest seq from local database {err}")
-            return
-        if local_data and local_data["MAX(seq)"] is not None:
-            local_max_seq = local_data["MAX(seq)"]
-        else:
-            local_max_seq = 0
-
-        step = 10   # number of reports in each loop
-        offset = 0
-        setMaxLocalSeq = local_max_seq  # if we delete local reports, we may loose highest seq
-        self.reports.clear()            # clear cache, we may get new data from server
-        error = False
-        while True and not error:
+            log.error(f"  Can't store reports from server in local database {err}")
+            self.sig.emit()
+            return False
+        self.invalidate(days)
+
+        ok = True
+        if srv_data.has_more:
+            # Get the rest as a stream, store one page at a time as it arrives
+            log.debugf(log.DEBUG_REPORTMGR, f"Sync() Stream remaining reports, from seq {srv_data.next_seq}")
             try:
-                url = f"{reportapi}/sync/{local_max_seq}"
-                params = {"limit": step, "offset": offset, "maxage": 180}
-                r = requests.get(url, params=params)
-                srv_reports = r.json()
-                srv_reports = srv_reports["data"]
-            except requests.exceptions.RequestException as err:
+                path = f"{reportapi}/sync/{srv_data.next_seq}"
+                params = {"stream": 1, "maxage": self.SYNC_MAXAGE}
+                with self.transport.get(path, params=params, stream=True) as r:
+                    r.raise_for_status()
+                    for srv_reports in util.iterNdjson(r, self.SYNC_PAGE_SIZE):
+                        days = set()
+                        with self.thread_db.transaction():
+                            max_seq = self._applyServerReports(srv_reports, max_seq, days)
+                            util.setSyncSeq(self.thread_db, "report", max_seq)
+                        self.invalidate(days)
+            except (requests.exceptions.RequestException, ValueError) as err:
                 log.error(f"  Can't get new/updated reports from server, {err}")
-                break
-
-            if len(srv_reports) < 1:
-                break   # no more data
-
-            log.debugf(log.DEBUG_REPORTMGR, f"------------------------------- offset {offset}")
-            for srv_report in srv_reports:
-                srv_report = AttrDict(srv_report)
-                # check if we have the report locally
-                try:
-                    sql = "SELECT * FROM report WHERE server_id=?"
-                    local_data = self.thread_db.select_one(sql, (srv_report._id,))
-                except db.DbException as err:
-                    log.error(f"  Can't load report from local database {err}")
-                    error = True
-                    break
-                if srv_report.seq > setMaxLocalSeq:
-                    setMaxLocalSeq = srv_report.seq
-                if local_data:
-                    # we already have report in local database
-                    local_report = local_data
-
-                    if srv_report.deleted:
-                        # report is marked as deleted on server, remove locally
-                        log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is deleted")
-                        try:
-                            sql = "DELETE FROM report WHERE _id=?"
-                            deleted_count = self.thread_db.delete(sql, (local_report._id,))
-                        except db.DbException as err:
-                            log.error(f"  Can't delete report from local database {err}")
-                            error = True
-                            break
-                        if deleted_count < 1:
-                            log.error("  Can't delete report from local database")
+                ok = False
+            except db.DbException as err:
+                log.error(f"  Can't store reports from server in local database {err}")
+                ok = False
 
-                    else:
-                        # report is updated on server, replace local copy with server report
-                        log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is updated")
-                        srv_report.server_id = srv_report._id
-                        srv_report._id = local_report._id
-                        try:
-                            self.thread_db.update("report", d=srv_report)
-                        except db.DbException as err:
-                            log.error(f"  Can't replace report in local database with one from server {err}")
-                            error = True
-                            break
-                else:
-                    # we don't have the report locally, store the one from the server as a new one
-                    if srv_report.deleted:
-                        # TODO maxseqnr
-                        continue    # Ignore the report, it is deleted and we dont have it locally
-                    log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is new")
-                    srv_report.server_id = srv_report._id
-                    srv_report._id = -1
-                    srv_report.updated = 0
-                    try:
-                        self.thread_db.insert("report", d=srv_report)
-                    except db.DbException as err:
-                        log.error(f"  Can't store new server report in local database {err}")
-                        error = True
-                        break
+        self.sig.emit()
+        return ok
 
-            offset += step
+    def _selectReports(self, ids):
+        """
+        Returns dict, _id -> report, for the local reports in ids
+        """
+        reports = {}
+        for ix in range(0, len(ids), self.SYNC_LOOKUP_SIZE):
+            chunk = ids[ix:ix + self.SYNC_LOOKUP_SIZE]
+            sql = "SELECT * FROM report WHERE _id IN (%s)" % ",".join("?" * len(chunk))
+            for report in self.thread_db.select_all(sql, chunk):
+                reports[report._id] = report
+        return reports
+
+    def _collectOutbox(self, entries):
+        """
+        Coalesce outbox entries, only the last change of each report matters
+        Returns (new reports, updated reports, server _id of deleted reports)
+        """
+        last = collections.OrderedDict()    # report_id -> last entry
+        for entry in entries:
+            last.pop(entry.report_id, None)
+            last[entry.report_id] = entry
+        reports = self._selectReports(list(last.keys()))
+
+        new_reports = []
+        updated_reports = []
+        deleted_ids = []
+        for report_id, entry in last.items():
+            report = reports.get(report_id)
+            if entry.op == "delete" or (report is not None and report.deleted):
+                server_id = report.server_id if report is not None else entry.server_id
+                if server_id >= 0:
+                    deleted_ids.append(server_id)
+                # else never reached the server, nothing to do
+            elif report is None:
+                continue
+            elif report.server_id < 0:
+                new_reports.append(report)
+            else:
+                updated_reports.append(report)
+        return new_reports, updated_reports, deleted_ids
 
-        if setMaxLocalSeq > local_max_seq:
-            # just get any report from local database, and set seq
+    def _ackOutbox(self, last_id, created, sent_reports, days):
+        """
+        Server has stored the changes, remove the sent outbox entries
+        Changes done during sync have higher _id and are kept
+        Should be called inside a transaction, the days of the sent reports are added to days
+        """
+        for report in sent_reports:
+            days.add(_reportDay(report.start))
+        for c in created:
+            self.thread_db.update("report", d={"_id": c["_id"], "server_id": c["server_id"]}, primary_key="_id")
+            # report may have been deleted while it was created on server, the delete is now sent with server_id
+            sql = "UPDATE outbox SET server_id=? WHERE report_id=?"
+            self.thread_db.execute(sql, (c["server_id"], c["_id"]))
+
+        self.thread_db.delete("DELETE FROM outbox WHERE _id <= ?", (last_id,))
+
+        ids = [report._id for report in sent_reports]
+        for ix in range(0, len(ids), self.SYNC_LOOKUP_SIZE):
+            chunk = ids[ix:ix + self.SYNC_LOOKUP_SIZE]
+            sql = "UPDATE report SET updated=0 WHERE _id IN (%s)" % ",".join("?" * len(chunk))
+            sql += " AND _id NOT IN (SELECT report_id FROM outbox)"
+            self.thread_db.execute(sql, chunk)
+
+    def _applyServerReports(self, srv_reports, max_seq, days):
+        """
+        Store reports received from server in local database, as a batch
+        Should be called inside a transaction, raises DbException on errors
+        The days of changed reports, before and after the change, are added to days
+        Returns the highest seq seen
+        """
+        srv_reports = [AttrDict(srv_report) for srv_report in srv_reports]
+
+        # find the reports we already have, with one lookup per chunk
+        local_ids = {}      # server _id -> local _id
+        local_days = {}     # server _id -> day of the local copy
+        server_ids = [srv_report._id for srv_report in srv_reports]
+        for ix in range(0, len(server_ids), self.SYNC_LOOKUP_SIZE):
+            chunk = server_ids[ix:ix + self.SYNC_LOOKUP_SIZE]
+            sql = "SELECT _id, server_id, start FROM report WHERE server_id IN (%s)" % ",".join("?" * len(chunk))
+            for row in self.thread_db.select_all(sql, chunk):
+                local_ids[row["server_id"]] = row["_id"]
+                local_days[row["server_id"]] = _reportDay(row["start"])
+
+        # reports changed locally after last push, the local change wins and is sent on next sync
+        sql = "SELECT DISTINCT report_id FROM outbox"
+        pending = set(row["report_id"] for row in self.thread_db.select_all(sql))
+
+        # reports removed locally while they were created on server, the local row is already
+        # gone but the delete is waiting in the outbox, _ackOutbox() has set their server_id
+        sql = "SELECT DISTINCT server_id FROM outbox WHERE op='delete' AND server_id >= 0"
+        pending_deletes = set(row["server_id"] for row in self.thread_db.select_all(sql))
+
+        inserts = []
+        updates = []
+        deletes = []
+        for srv_report in srv_reports:
+            if srv_report.seq > max_seq:
+                max_seq = srv_report.seq
+            local_id = local_ids.get(srv_report._id)
+            if local_id is not None and local_id in pending:
+                log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} has local changes, ignored")
+                continue
+            if srv_report._id in pending_deletes:
+                log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is deleted locally, ignored")
+                continue
+            if srv_report.deleted:
+                if local_id is not None:
+                    # report is marked as deleted on server, remove locally
+                    log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is deleted")
+                    deletes.append(local_id)
+                    days.add(local_days[srv_report._id])
+                # else ignore the report, it is deleted and we dont have it locally
+                continue
+            srv_report.server_id = srv_report._id
+            srv_report.updated = 0
+            days.add(_reportDay(srv_report.start))
+            if local_id is not None:
+                days.add(local_days[srv_report._id])
+                # report is updated on server, replace local copy with server report
+                log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is updated")
+                srv_report._id = local_id
+                updates.append(srv_report)
+            else:
+                # we don't have the report locally, store the one from the server as a new one
+                log.debugf(log.DEBUG_REPORTMGR, f"  From server, report with _id {srv_report._id} is new")
+                srv_report._id = -1
+                inserts.append(srv_report)
+
+        for ix in range(0, len(deletes), self.SYNC_LOOKUP_SIZE):
+            chunk = deletes[ix:ix + self.SYNC_LOOKUP_SIZE]
+            sql = "DELETE FROM report WHERE _id IN (%s)" % ",".join("?" * len(chunk))
+            self.thread_db.delete(sql, chunk)
+        if updates:
+            self.thread_db.update_many("report", rows=updates, primary_key="_id")
+        if inserts:
+            self.thread_db.insert_many("report", rows=inserts, primary_key="_id")
+        log.debugf(log.DEBUG_REPORTMGR, f"  Stored {len(inserts)} new, {len(updates)} updated, "
+                                        f"{len(deletes)} deleted reports from server")
+        return max_seq
+
+    def _prefetchDays(self, days):
+        """
+        Load days into the cache, skipping the ones already there
+        """
+        for day in days:
+            with self._cacheLock:
+                if day in self._days:
+                    continue
+                gen = self._cacheGen
             try:
-                sql = "SELECT * FROM report ORDER BY seq desc LIMIT 1"
-                local_report = self.thread_db.select_one(sql)
+                reports = self._loadDay(self.thread_db, day)
             except db.DbException as err:
-                log.error(f"  Can't get highest seq from local database {err}")
+                log.error(f"Cannot prefetch reports from local database {err}")
                 return
-            if local_report:
-                if local_report.seq < setMaxLocalSeq:
-                    local_report.seq = setMaxLocalSeq
-                    try:
-                        self.thread_db.update("report", d=local_report)
-                    except db.DbException as err:
-                        log.error(f"  Can't update highest seq in local database {err}")
-
-        self.sig.emit()
+            log.debugf(log.DEBUG_REPORTMGR, f"Prefetched {len(reports)} reports for {day}")
+            self._cachePut(day, reports, gen)
 
     def runThread(self):
         log.debugf(log.DEBUG_REPORTMGR, "Starting reportmgr thread")
@@ -423,20 +707,50 @@ the trigger is configured like this
         # to simplify database operations
         log.debugf(log.DEBUG_REPORTMGR, "Opening local database")
         self.thread_db = util.openLocalDatabase2()
+        self.transport = transport.Transport()
 
         while True:
-            req = self.toThreadQ.get()
-            log.debugf(log.DEBUG_REPORTMGR, f"reportmgr, request={req}")
-            if req[0] == "quit":
-                log.debugf(log.DEBUG_REPORTMGR, "reportmgr thread stopping")
-                return
+            with self._cond:
+                # wait for a sync to be due, days to prefetch, or quit
+                while self._syncDue is None or self._syncDue > time.monotonic():
+                    if self._quit:
+                        if self._syncDue is None:
+                            break
+                        self._syncDue = time.monotonic()    # do requested sync before quitting
+                        continue
+                    if self._prefetchQ:
+                        break
+                    if self._syncDue is None:
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(self._syncDue - time.monotonic())
+                if self._quit and self._syncDue is None:
+                    log.debugf(log.DEBUG_REPORTMGR, "reportmgr thread stopping")
+                    self.transport.close()
+                    return
+                prefetch = self._prefetchQ
+                self._prefetchQ = []
+                if self._syncDue is not None and self._syncDue <= time.monotonic():
+                    # everything requested until now is handled by this sync
+                    self._syncDue = None
+                    requested = self._requested
+                else:
+                    requested = None
 
-            elif req[0] == "sync":
-                log.info("Sync reports with server started")
-                self._do_sync()
-                log.info("Sync reports with server finished")
-            else:
-                log.error(log.DEBUG_REPORTMGR, f"reportmgr thread, unknown command {req[0]}")
+            if prefetch:
+                self._prefetchDays(prefetch)
+            if requested is None:
+                continue
+
+            log.info("Sync reports with server started")
+            ok = self._do_sync()
+            log.info(f"Sync reports with server finished, {'ok' if ok else 'failed'}")
+
+            with self._cond:
+                self._completed = requested
+                self._syncResult = ok
+                self._cond.notify_all()
+            self.syncDone.emit(ok)
 
 
 if __name__ == "__main__":
@@ -452,9 +766,9 @@ if __name__ == "__main__":
 
     reportMgr = ReportMgr(localdb=localdb)
     reportMgr.init()
-    reportMgr.sync()
+    reportMgr.sync(now=True)
     reportMgr.stop()
 
-    while not reportMgr.toThreadQ.empty():
+    while reportMgr.t.is_alive():
         QApplication.processEvents()
         time.sleep(0.5)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Model for the table with reports in the main window
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import PyQt5.QtCore as QtCore
+
+
+def _strMinutes(minutes):
+    return f"{minutes // 60:.0f}:{minutes % 60:02.0f}"
+
+
+class ReportTableModel(QtCore.QAbstractTableModel):
+    """
+    Reports shown in the table, with a total as last row
+
+    The text of each row is formatted once, when the reports are set.
+    setReports() compares the new list with the current one and only
+    signals the rows that are inserted, removed or changed, so the view
+    keeps selection and scroll position and only repaints what changed
+    """
+
+    headers = ("Activity", "Project", "Start", "Stop", "Len", "Flags", "Comment")
+
+    def __init__(self, activitymgr=None, parent=None):
+        super().__init__(parent)
+        self.activitymgr = activitymgr
+        self.ids = []           # report _id, per row
+        self.rows = []          # tuple with text for each column, per row
+        self.total = self._totalRow(0)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows) + 1
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == QtCore.Qt.DisplayRole:
+            if row < len(self.rows):
+                return self.rows[row][index.column()]
+            return self.total[index.column()]
+        if role == QtCore.Qt.UserRole:
+            return self.reportId(row)
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def reportId(self, row):
+        """
+        Returns _id of report in row, None for the total row
+        """
+        if 0 <= row < len(self.ids):
+            return self.ids[row]
+        return None
+
+    def _displayRow(self, r, activityNames):
+        """
+        Returns (tuple with text for each column, length in minutes)
+        """
+        name = activityNames.get(r.activityid)
+        if name is None:
+            a = self.activitymgr.get(r.activityid)
+            name = a.name if a is not None else "Unknown"
+            activityNames[r.activityid] = name
+
+        try:
+            start = r.start.strftime("%H:%M")
+        except AttributeError:
+            start = "None"
+        try:
+            stop = r.stop.strftime("%H:%M")
+        except AttributeError:
+            stop = "None"
+
+        minutes = 0
+        if r.start is not None and r.stop is not None:
+            minutes = (r.stop - r.start).total_seconds() / 60
+            length = _strMinutes(minutes)
+        else:
+            length = "None"
+
+        flags = ""
+        if r.server_id is not None and r.server_id > -1:
+            flags += f"on server({r.server_id})"
+        if r.updated:
+            flags += " updated"
+        if r.deleted:
+            flags += " remove"
+
+        return (name, "?", start, stop, length, flags, r.comment), minutes
+
+    def _totalRow(self, minutes):
+        return ("Total", "", "", "", _strMinutes(minutes), "", "")
+
+    def setReports(self, reports):
+        """
+        Show reports, updating the view with as few changes as possible
+        """
+        activityNames = {}
+        new_ids = []
+        new_rows = []
+        totalMinutes = 0
+        for r in reports:
+            display, minutes = self._displayRow(r, activityNames)
+            new_ids.append(r._id)
+            new_rows.append(display)
+            totalMinutes += minutes
+
+        # reports still shown must be in the same order, otherwise start over
+        # Also start over if no report is kept, for example another day is shown
+        new_set = set(new_ids)
+        old_set = set(self.ids)
+        kept = [i for i in self.ids if i in new_set]
+        if not kept or kept != [i for i in new_ids if i in old_set]:
+            self.beginResetModel()
+            self.ids = new_ids
+            self.rows = new_rows
+            self.total = self._totalRow(totalMinutes)
+            self.endResetModel()
+            return
+
+        # remove rows, from the end so row numbers are valid
+        for row in range(len(self.ids) - 1, -1, -1):
+            if self.ids[row] not in new_set:
+                self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+                del self.ids[row]
+                del self.rows[row]
+                self.endRemoveRows()
+
+        # insert rows, the remaining rows are in the same order so
+        # any difference is a new report
+        for row, _id in enumerate(new_ids):
+            if row >= len(self.ids) or self.ids[row] != _id:
+                self.beginInsertRows(QtCore.QModelIndex(), row, row)
+                self.ids.insert(row, _id)
+                self.rows.insert(row, new_rows[row])
+                self.endInsertRows()
+
+        lastColumn = len(self.headers) - 1
+        for row, display in enumerate(new_rows):
+            if self.rows[row] != display:
+                self.rows[row] = display
+                self.dataChanged.emit(self.index(row, 0), self.index(row, lastColumn))
+
+        total = self._totalRow(totalMinutes)
+        if total != self.total:
+            self.total = total
+            row = len(self.rows)
+            self.dataChanged.emit(self.index(row, 0), self.index(row, lastColumn))
@@ -50,15 +50,19 @@ class MySettings(QtCore.QObject):
     username               = AttrTypDefault(str, getpass.getuser())
     password               = AttrTypDefault(str, "")
     idle_timeout           = AttrTypDefault(int, 600)
+    checkpoint_interval    = AttrTypDefault(int, 60)    # seconds, save running report this often, 0=never
     database_dir           = AttrTypDefault(str, "")
     loglevel               = AttrTypDefault(str, "INFO")
 
     activity_sync_interval = AttrTypDefault(int, 600)
 
     report_sync_interval   = AttrTypDefault(int, 600)
+    report_sync_debounce   = AttrTypDefault(int, 5)     # seconds, edits within this time are sent in one sync
 
     server_url             = AttrTypDefault(str, "http://ergotime.int.abundo.se")
     networkTimeout         = AttrTypDefault(int, 60)
+    networkRetries         = AttrTypDefault(int, 3)
+    networkCompress        = AttrTypDefault(bool, True)   # gzip request bodies
 
     userdir                = AttrTypDefault(str, os.path.expanduser("~") + os.sep + ".ergotime")
     userconffile           = AttrTypDefault(str, "")
@@ -46,7 +46,11 @@ class Timetracker(QtCore.QObject):
     change state
     sends signals when things change, so GUI can update
 
-    when state is active, a _timer periodically checks if user has been idle
+    when state is active, an IdleMonitor checks if user has been idle, and while
+    the GUI is visible a _guiTimer sends status every second
+
+    the running report is saved to the local database every
+    sett.checkpoint_interval seconds, so it can be recovered after a crash
     """
 
     stateStartup = 1   # Only used during program startup
@@ -64,7 +68,23 @@ class Timetracker(QtCore.QObject):
         self.reportmgr = reportmgr
 
         self.report = parent._getNewReport()
-        self._timer = None
+
+        self._idleMonitor = idle_dectect.IdleMonitor(sett.idle_timeout, parent=self)
+        self._idleMonitor.idleTimeout.connect(self._idleDetected)
+
+        self._guiVisible = True
+        self._guiTimer = QtCore.QTimer(self)
+        self._guiTimer.setInterval(1000)
+        self._guiTimer.timeout.connect(self._update)
+
+        self._checkpointTimer = QtCore.QTimer(self)
+        self._checkpointTimer.timeout.connect(self._checkpoint)
+
+        # checkpoint soon after the GUI changes the running report
+        self._changedTimer = QtCore.QTimer(self)
+        self._changedTimer.setSingleShot(True)
+        self._changedTimer.setInterval(1000)
+        self._changedTimer.timeout.connect(self._checkpoint)
 
         self.idleStartTime = None
         self.currentReport = None
@@ -72,6 +92,8 @@ class Timetracker(QtCore.QObject):
         self.state = self.stateStartup
         self._status = Status()
 
+        sett.updated.connect(self.options_changed)
+
     def init(self):
         self.setStateInactive()
 
@@ -88,8 +110,7 @@ class Timetracker(QtCore.QObject):
             log.error("Incorrect state change, inactive->inactive")
 
         elif self.state == self.stateActive:
-            self._timer.stop()
-            self._timer = None
+            self._stopTimers()
             self._saveReport()
 
             self.state = self.stateInactive
@@ -106,13 +127,14 @@ class Timetracker(QtCore.QObject):
         """
         if self.state == self.stateInactive:
             self.report = report
-            self._timer = QtCore.QTimer()
-            self._timer.timeout.connect(self._update)
-            self._update()
-            self._timer.start(1000)
-
             self.state = self.stateActive
+            self._idleMonitor.start()
+            self._update()
+            self._updateGuiTimer()
             self.stateSignal.emit(self.stateActive)
+            # after the GUI has copied its values to the report
+            self._checkpoint()
+            self._updateCheckpointTimer()
 
         elif self.state == self.stateActive:
             log.error("Incorrect state change, active->active")
@@ -122,19 +144,20 @@ class Timetracker(QtCore.QObject):
         else:
             log.error(f"Incorrect state {self.state}")
 
-    def setStateIdle(self):
+    def setStateIdle(self, idle_seconds=None):
         """
         Idle detected, save current report and go to Inactive
         This is an internal state, external GUI only knows about Inactive/Active
         Subtract the idle period before going to inactive
         """
+        if idle_seconds is None:
+            idle_seconds = sett.idle_timeout
         if self.state == self.stateInactive:
             log.error("Incorrect state change, inactive->idle")
 
         elif self.state == self.stateActive:
-            self._timer.stop()
-            self._timer = None
-            self._saveReport(subtract_seconds=sett.idle_timeout)
+            self._stopTimers()
+            self._saveReport(subtract_seconds=idle_seconds)
             self.state = self.stateInactive
             self.stateSignal.emit(self.stateInactive)
 
@@ -143,6 +166,47 @@ class Timetracker(QtCore.QObject):
         else:
             log.error(f"Incorrect state {self.state}")
 
+    def discardReport(self):
+        """
+        Stop without saving the running report
+        """
+        if self.state == self.stateActive:
+            self._stopTimers()
+            self.reportmgr.discard(self.report)
+            self.state = self.stateInactive
+            self.stateSignal.emit(self.stateInactive)
+        else:
+            log.error(f"Incorrect state change, discard in state {self.state}")
+
+    def _stopTimers(self):
+        self._idleMonitor.stop()
+        self._guiTimer.stop()
+        self._checkpointTimer.stop()
+        self._changedTimer.stop()
+
+    def reportChanged(self):
+        """
+        Called when the GUI changes the running report
+        """
+        if self.state == self.stateActive and sett.checkpoint_interval > 0:
+            self._changedTimer.start()
+
+    def _checkpoint(self):
+        """
+        Save the running report, stop is set to now
+        """
+        if self.state != self.stateActive or sett.checkpoint_interval <= 0:
+            return
+        self.report.stop = datetime.datetime.now().replace(microsecond=0)
+        log.debug(f"Checkpoint report {self.report}")
+        self.reportmgr.checkpoint(self.report)
+
+    def _updateCheckpointTimer(self):
+        if self.state == self.stateActive and sett.checkpoint_interval > 0:
+            self._checkpointTimer.start(sett.checkpoint_interval * 1000)
+        else:
+            self._checkpointTimer.stop()
+
     def _saveReport(self, subtract_seconds=0):
         log.debug(f"Saving report {self.report}")
         self.report.stop = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(seconds=subtract_seconds)
@@ -156,10 +220,31 @@ class Timetracker(QtCore.QObject):
         tmp = datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=seconds)
         return tmp.time()
 
+    def _idleDetected(self, idle_seconds):
+        log.info(f"Idle timeout detected, idle {idle_seconds} seconds")
+        self.setStateIdle(idle_seconds)
+
+    def setGuiVisible(self, visible):
+        """
+        Called when the main window is shown or hidden
+        Status is only sent while someone can see it
+        """
+        self._guiVisible = visible
+        self._updateGuiTimer()
+        if visible and self.state == self.stateActive:
+            self._update()
+
+    def _updateGuiTimer(self):
+        if self.state == self.stateActive and self._guiVisible:
+            if not self._guiTimer.isActive():
+                self._guiTimer.start()
+        else:
+            self._guiTimer.stop()
+
     def _update(self):
         """
-        Called every second when state == stateActive
-        Check if idle
+        Called every second when state == stateActive and the GUI is visible
+        Send status, so GUI can show it
         """
         self.report.stop = datetime.datetime.now().replace(microsecond=0)
         td = self.report.stop - self.report.start
@@ -167,15 +252,12 @@ class Timetracker(QtCore.QObject):
 
         idle_seconds = idle_dectect.get_idle()
         self._status.idle = self._seconds_to_time(idle_seconds)
-        if idle_seconds > sett.idle_timeout:
-            log.info("Idle timeout detected")
-            self.setStateIdle()
-            return
-
         self.activeUpdated.emit(self._status)
 
     def options_changed(self):
         """
         Called when user changes options
         """
-        pass
+        self._idleMonitor.setTimeout(sett.idle_timeout)
+        if self._checkpointTimer.interval() != sett.checkpoint_interval * 1000:
+            self._updateCheckpointTimer()
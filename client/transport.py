@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+HTTP transport to the server
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import json
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+from logger import log
+from settings import sett
+
+
+# Methods that can be resent without side effects if the response is lost
+IDEMPOTENT_METHODS = frozenset(["HEAD", "GET", "PUT", "DELETE", "OPTIONS"])
+
+COMPRESS_MIN_SIZE = 1024    # bytes, smaller request bodies are sent as is
+
+
+def _retry(retries):
+    """
+    Retry connection errors for all methods, nothing has been sent then.
+    Read errors and 502/503/504 are only retried for idempotent methods
+    """
+    kwargs = dict(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+
+class Transport:
+    """
+    A requests.Session to the server, one per manager thread
+
+    Connections are kept alive and reused between requests. All requests
+    use sett.networkTimeout, and the server url is prepended to the path
+    """
+
+    def __init__(self, retries=None):
+        if retries is None:
+            retries = sett.networkRetries
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=2, max_retries=_retry(retries))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def request(self, method, path, json_data=None, **kwargs):
+        """
+        Send a request, json_data is encoded as json and compressed if
+        large enough. Returns the requests.Response
+        """
+        kwargs.setdefault("timeout", sett.networkTimeout)
+        if json_data is not None:
+            headers = kwargs.setdefault("headers", {})
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(json_data).encode("utf-8")
+            if sett.networkCompress and len(body) >= COMPRESS_MIN_SIZE:
+                log.debugf(log.DEBUG_TRANSPORT, f"Compressing request body, {len(body)} bytes")
+                body = gzip.compress(body, compresslevel=6)
+                headers["Content-Encoding"] = "gzip"
+            kwargs["data"] = body
+        return self.session.request(method, f"{sett.server_url}{path}", **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, json_data=None, **kwargs):
+        return self.request("POST", path, json_data=json_data, **kwargs)
+
+    def put(self, path, json_data=None, **kwargs):
+        return self.request("PUT", path, json_data=json_data, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -20,6 +20,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import sys
+import json
+import datetime
+
+from orderedattrdict import AttrDict
 
 import PyQt5.QtWidgets as QtWidgets
 
@@ -28,6 +32,8 @@ from settings import sett
 import resource
 
 import lib.db as db
+import lib.migrate
+import migrations
 
 
 def createQApplication():
@@ -40,50 +46,75 @@ def createQApplication():
     return app
 
 
+def iterNdjson(response, batch_size=100):
+    """
+    Read a streamed, newline delimited json, response
+    Yields lists with up to batch_size rows, as they are received
+    """
+    batch = []
+    for line in response.iter_lines():
+        if not line:
+            continue
+        batch.append(json.loads(line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Set on every connection to the local database.
+# WAL lets the GUI thread read while the sync threads write, busy_timeout
+# makes a writer wait for another writer instead of failing
+localPragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",    # safe with WAL, fsync only at checkpoint
+    "cache_size": -16000,       # negative is KiB
+    "mmap_size": 67108864,
+    "busy_timeout": 5000,       # ms
+    "temp_store": "MEMORY",
+}
+
+
 def openLocalDatabase2(dbname=None):
-    dbconf = {"name": sett.localDatabaseName}
+    dbconf = {"name": sett.localDatabaseName, "pragmas": localPragmas}
     conn = db.Database(dbconf, driver="sqlite")
     conn.connect()
     log.info(f"Open local database {dbconf}")
 
-    sql = "CREATE TABLE IF NOT EXISTS report ("
-    sql += "  _id         INTEGER PRIMARY KEY, "
-    sql += "  user_id     INT  NOT NULL default -1, "
-    sql += "  activityid  INT  NOT NULL default -1, "
-    sql += "  start       TIMESTAMP NOT NULL, "
-    sql += "  stop        TIMESTAMP NOT NULL, "
-    sql += "  comment     TEXT NOT NULL default '', "
-
-    sql += "  modified    TIMESTAMP NOT NULL, "
-    sql += "  seq         INT  NOT NULL default -1, "
-    sql += "  deleted     INT  NOT NULL default  0, "
-
-    sql += "  server_id   INT  NOT NULL default -1, "
-    sql += "  updated     INT  NOT NULL default -1 "
-    sql += ");"
-    conn.execute(sql)
-
-    sql = "CREATE TABLE IF NOT EXISTS activity ("
-    sql += "  _id         INTEGER PRIMARY KEY, "
-    sql += "  name        TEXT NOT NULL default '', "
-    sql += "  description TEXT NOT NULL default '', "
-    sql += "  project_id  INT  NOT NULL default -1, "
-    sql += "  active      INT  NOT NULL default  0, "
-    sql += "  server_id   INT  NOT NULL default -1 "
-    sql += ");"
-    conn.execute(sql)
-
-    sql = "CREATE TABLE IF NOT EXISTS project ("
-    sql += "  _id         INTEGER PRIMARY KEY, "
-    sql += "  activity_id INT  NOT NULL default -1, "
-    sql += "  name        TEXT NOT NULL default '', "
-    sql += "  costcenter  TEXT NOT NULL default '', "
-    sql += "  active      INT  NOT NULL default  0 "
-    sql += ");"
-    conn.execute(sql)
-
+    migrator = lib.migrate.Migrator(conn, migrations.migrations)
+    migrator.migrate(log=log)
     return conn
 
 
+def getSyncState(conn, entity):
+    """
+    Returns sync state for entity, "report" or "activity"
+      seq   highest server seq stored locally
+      etag  ETag from last response, if the server sent one
+    """
+    row = conn.select_one("SELECT * FROM sync_state WHERE entity=?", (entity,))
+    if row is None:
+        row = AttrDict(entity=entity, seq=0, etag="", synced=None)
+    return row
+
+
+def getSyncSeq(conn, entity):
+    """
+    Returns the highest server seq stored locally for entity
+    """
+    return getSyncState(conn, entity).seq
+
+
+def setSyncSeq(conn, entity, seq, etag=None):
+    """
+    Save the highest server seq stored locally. Call in the same transaction
+    as the data is stored, so the watermark never gets ahead of the data
+    """
+    d = {"entity": entity, "seq": seq, "synced": datetime.datetime.now()}
+    if etag is not None:
+        d["etag"] = etag
+    conn.update("sync_state", d=d, primary_key="entity")
+
 if __name__ == "__main__":
     openLocalDatabase2("c:/temp/ergotime.db")
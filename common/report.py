@@ -42,3 +42,4 @@ class Report(AttrDict):
         
         self.server_id = -1     # used on client, _id on server
         self.updated = 0        # used on client, indicates local updates need sync
+        self.running = 0        # used on client, report is running in timetracker, stop is last checkpoint
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Report aggregation, sums are calculated in the database
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+def strSeconds(seconds, includeDecimal=False):
+    """
+    Convert seconds to hours and minutes, used for all reported time on the server
+    """
+    hours = seconds / 3600
+    minutes = (seconds / 60) % 60
+    res = "%02i:%02i" % (hours, minutes)
+    if includeDecimal:
+        res += "\n(%i.%02i)" % (hours, minutes * 100 / 60)
+    return res
+
+
+class Total:
+    """
+    One aggregated row. Columns not part of the grouping are None
+    """
+    def __init__(self, row):
+        self.period = row.get("period")
+        self.user_id = row.get("user_id")
+        self.user_name = row.get("user_name")
+        self.activityid = row.get("activityid")
+        self.activity_name = row.get("activity_name")
+        self.seconds = int(row["seconds"] or 0)
+        self.count = int(row["count"] or 0)
+
+    def strTotal(self, includeDecimal=False):
+        return strSeconds(self.seconds, includeDecimal=includeDecimal)
+
+
+class Totals:
+    """
+    Result from an aggregation, list of Total and sum of all of them
+    """
+    def __init__(self, group_by):
+        self.group_by = group_by
+        self.rows = []
+        self.seconds = 0
+        self.count = 0
+
+    def add(self, total):
+        self.rows.append(total)
+        self.seconds += total.seconds
+        self.count += total.count
+
+    def strTotal(self, includeDecimal=False):
+        return strSeconds(self.seconds, includeDecimal=includeDecimal)
+
+
+class ReportAggregate:
+    """
+    Sum reported time with GROUP BY in PostgreSQL, so no individual reports
+    are fetched. Handles any range, a month, a year or several years, for
+    one, some or all users
+
+    group_by is a tuple with one period and/or "activity" and "user"
+
+    If rollup is True the sums are read from report_daily_rollup, which is
+    already summed per user, activity and day, instead of from report
+    """
+
+    periods = ["day", "week", "month", "year"]
+
+    def __init__(self, db=None, rollup=False):
+        self.db = db
+        self.rollup = rollup
+
+    def totals(self, start, stop, group_by=("month", "activity"), userids=None, activityids=None):
+        """
+        Sum reports with start >= start and start < stop
+        Returns a Totals()
+        """
+        columns = []
+        groups = []
+        joins = []
+        order = []
+        values = []
+
+        if self.rollup:
+            table = "report_daily_rollup AS report"
+            startcol = "report.day"
+            seconds = "SUM(report.total_seconds)"
+            count = "SUM(report.count)"
+            where = []
+        else:
+            table = "report"
+            startcol = "report.start"
+            seconds = "SUM(EXTRACT(EPOCH FROM report.stop - report.start))::bigint"
+            count = "COUNT(*)"
+            where = ["report.deleted=0"]
+
+        for group in group_by:
+            if group in self.periods:
+                columns.append(f"date_trunc('{group}', {startcol}) AS period")
+                groups.append("period")
+                order.append("period")
+            elif group == "activity":
+                columns.append("report.activityid, activity.name AS activity_name")
+                groups.append("report.activityid, activity.name")
+                joins.append("LEFT JOIN activity ON activity._id=report.activityid")
+                order.append("activity.name")
+            elif group == "user":
+                columns.append("report.user_id, users.name AS user_name")
+                groups.append("report.user_id, users.name")
+                joins.append("LEFT JOIN users ON users._id=report.user_id")
+                order.append("users.name")
+            else:
+                raise ValueError(f"Can't group reports by {group}")
+
+        columns.append(f"{seconds} AS seconds")
+        columns.append(f"{count} AS count")
+
+        sql = "SELECT " + ", ".join(columns) + " FROM " + table
+        if joins:
+            sql += " " + " ".join(joins)
+        where.append(f"{startcol}>=%s AND {startcol}<%s")
+        sql += " WHERE " + " AND ".join(where)
+        values.append(start)
+        values.append(stop)
+        if userids:
+            sql += " AND report.user_id = ANY(%s)"
+            values.append(list(userids))
+        if activityids:
+            sql += " AND report.activityid = ANY(%s)"
+            values.append(list(activityids))
+        if groups:
+            sql += " GROUP BY " + ", ".join(groups)
+            sql += " ORDER BY " + ", ".join(order)
+
+        res = Totals(group_by)
+        for row in self.db.select_all(sql, values):
+            res.add(Total(row))
+        return res
+
+    def per_day(self, start, stop, userids=None, activityids=None):
+        return self.totals(start, stop, ("day", "activity"), userids, activityids)
+
+    def per_month(self, start, stop, userids=None, activityids=None):
+        return self.totals(start, stop, ("month", "activity"), userids, activityids)
+
+    def per_activity(self, start, stop, userids=None, activityids=None):
+        return self.totals(start, stop, ("activity",), userids, activityids)
+
+    def per_user(self, start, stop, userids=None, activityids=None):
+        return self.totals(start, stop, ("user",), userids, activityids)
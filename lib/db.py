@@ -19,20 +19,205 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import time
+import itertools
+import threading
+import contextlib
+import collections
+
 from orderedattrdict import AttrDict
 
 
+_cursor_id = itertools.count()     # unique names for server side cursors
+
+
 class DbException(Exception):
     pass
 
 
+class State:
+    """
+    Connection and cursor used by a Database
+    """
+    def __init__(self):
+        self.conn = None
+        self.cursor = None
+        self.pooled = None      # PooledConnection, if checked out from a pool
+        self.txdepth = 0        # nesting level of transaction()
+        self.prepared = None    # names of statements prepared on conn
+
+
+class PooledConnection:
+    """
+    A connection owned by the ConnectionPool, with bookkeeping
+    used to decide when it should be health checked or retired
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.prepared = set()   # prepared statements lives as long as the connection
+
+
+class Statement:
+    """
+    SQL for one insert or update shape, built once and cached
+
+    columns   column names, in the order values should be given
+    sql       statement with placeholders
+    params    number of placeholders
+    name      if set, the statement is prepared on the server with this name
+    """
+    def __init__(self, columns, sql, params, name=None):
+        self.columns = columns
+        self.sql = sql
+        self.name = name
+        if name:
+            self.execute_sql = "EXECUTE %s (%s)" % (name, ",".join(["%s"] * params))
+
+
+class StatementCache:
+    """
+    Thread safe cache of Statement, key is (op, table, columns, primary_key, driver)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.names = itertools.count()
+
+    def get(self, key, build):
+        """
+        Return cached statement, call build(name) to create it if missing
+        """
+        with self.lock:
+            stmt = self.statements.get(key)
+            if stmt is None:
+                stmt = build("stmt_%d" % next(self.names))
+                self.statements[key] = stmt
+            return stmt
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of database connections
+
+    size          maximum number of connections, idle and checked out
+    max_idle      close connections that has been unused this many seconds
+    max_lifetime  close connections older than this many seconds
+    check_after   health check connections idle longer than this many seconds
+    """
+    def __init__(self, connect, size=5, max_idle=300, max_lifetime=3600, check_after=30, timeout=30):
+        self._connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self.timeout = timeout
+
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _expired(self, pc, now):
+        if self.max_lifetime and now - pc.created > self.max_lifetime:
+            return True
+        if self.max_idle and now - pc.last_used > self.max_idle:
+            return True
+        return False
+
+    def _healthy(self, pc):
+        """
+        Verify that the server still talks to us. psycopg2 exposes a closed
+        flag, for the other drivers a trivial query is needed
+        """
+        if getattr(pc.conn, "closed", 0):
+            return False
+        try:
+            cursor = pc.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            pc.conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, pc):
+        try:
+            pc.conn.close()
+        except Exception:
+            pass
+
+    def get(self):
+        """
+        Check out a connection, create a new one if no idle connection is available
+        Blocks if all connections are in use
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise DbException("Timeout waiting for a free connection in the pool")
+        try:
+            while True:
+                with self._lock:
+                    pc = self._idle.pop() if self._idle else None
+                if pc is None:
+                    return PooledConnection(self._connect())
+                now = time.monotonic()
+                if self._expired(pc, now):
+                    self._close(pc)
+                    continue
+                if now - pc.last_used > self.check_after and not self._healthy(pc):
+                    self._close(pc)
+                    continue
+                return pc
+        except Exception:
+            self._slots.release()
+            raise
+
+    def put(self, pc, discard=False):
+        """
+        Return a connection to the pool. Any uncommitted transaction is rolled back
+        """
+        try:
+            if not discard:
+                try:
+                    pc.conn.rollback()
+                except Exception:
+                    discard = True
+            if discard or self._expired(pc, time.monotonic()):
+                self._close(pc)
+            else:
+                pc.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(pc)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            while self._idle:
+                self._close(self._idle.pop())
+
+
 class Database:
     """
     Handle database connections
 
     Keep the connection open, and if any error try to reconnect
     before returning any errors
+
+    If db_conf has a pool_size, connections are taken from a ConnectionPool.
+    Each thread then gets its own connection, checked out on first use and
+    returned to the pool with release(), typically at the end of a request
     """
+    BULK_MAX_PARAMS = 999   # max parameters in one statement, sqlite before 3.32 allows 999
+
     def __init__(self, db_conf, driver=None):
         self.db_conf = db_conf
         if "driver" in self.db_conf:
@@ -40,6 +225,10 @@ class Database:
         else:
             self.driver = driver
 
+        self.pool = None
+        self._local = threading.local()
+        self._shared = State()
+
         self.conn = None
         self.cursor = None
         self.dbexception = DbException
@@ -51,57 +240,147 @@ class Database:
         if self.driver == "sqlite":
             self.valueholder = "?"
 
-    def connect(self):
-        if self.conn:
-            return self.conn
-
+        # Use server side PREPARE for insert() and update(), psql only
+        # Disable if connections go through a pooler in transaction mode
+        self.prepare = self.driver == "psql" and self.db_conf.get("prepare_statements", True)
+        self.statements = StatementCache()
+
+        pool_size = self.db_conf.get("pool_size", 0)
+        if pool_size:
+            self.pool = ConnectionPool(
+                self._new_connection,
+                size=pool_size,
+                max_idle=self.db_conf.get("pool_max_idle", 300),
+                max_lifetime=self.db_conf.get("pool_max_lifetime", 3600),
+                check_after=self.db_conf.get("pool_check_after", 30),
+                timeout=self.db_conf.get("pool_timeout", 30))
+
+    @property
+    def _state(self):
+        """
+        Connection state, per thread if pooled, otherwise shared
+        """
+        if self.pool is None:
+            return self._shared
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = State()
+            self._local.state = state
+        return state
+
+    @property
+    def conn(self):
+        return self._state.conn
+
+    @conn.setter
+    def conn(self, value):
+        self._state.conn = value
+
+    @property
+    def cursor(self):
+        return self._state.cursor
+
+    @cursor.setter
+    def cursor(self, value):
+        self._state.cursor = value
+
+    def _new_connection(self):
+        """
+        Open a new connection to the database
+        """
         if self.driver == "psql":
             import psycopg2
-            import psycopg2.extras
             self.dbexception = psycopg2.Error
 
-            self.conn = psycopg2.connect(
+            conn = psycopg2.connect(
                 host=self.db_conf["host"],
                 user=self.db_conf["user"],
                 password=self.db_conf["pass"],
                 database=self.db_conf["name"])
-            self.conn.autocommit = False
-
-            # return querys as dictionaries
-            self.cursor = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            conn.autocommit = False
 
         elif self.driver == "mysql":
             import pymysql
             import pymysql.cursors
             self.dbexception = pymysql.MySQLError
 
-            self.conn = pymysql.connect(
+            conn = pymysql.connect(
                 host=self.db_conf["host"],
                 user=self.db_conf["user"],
                 passwd=self.db_conf["pass"],
                 db=self.db_conf["name"],
                 cursorclass=pymysql.cursors.DictCursor)
-            self.cursor = self.conn.cursor()
 
         elif self.driver == "sqlite":
             import sqlite3
             self.dbexception = sqlite3.Error
 
-            self.conn = sqlite3.connect(self.db_conf["name"],
-                                        check_same_thread=False,
-                                        detect_types=sqlite3.PARSE_DECLTYPES)
-            self.conn.row_factory = sqlite3.Row   # return querys as dictionaries
-            self.cursor = self.conn.cursor()
+            conn = sqlite3.connect(self.db_conf["name"],
+                                   check_same_thread=False,
+                                   detect_types=sqlite3.PARSE_DECLTYPES)
+            conn.row_factory = sqlite3.Row   # return querys as dictionaries
+            # per connection settings, for example journal_mode, synchronous, cache_size
+            for name, value in self.db_conf.get("pragmas", {}).items():
+                conn.execute(f"PRAGMA {name}={value}")
 
-        return self.conn
+        return conn
 
-    def disconnect(self):
-        if self.cursor:
-            self.cursor.close()
-            self.cursor = None
+    def _new_cursor(self, conn):
+        if self.driver == "psql":
+            import psycopg2.extras
+            # return querys as dictionaries
+            return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        return conn.cursor()
+
+    def connect(self):
         if self.conn:
-            self.conn.close()
-        self.conn = None
+            return self.conn
+
+        state = self._state
+        if self.pool:
+            state.pooled = self.pool.get()
+            state.conn = state.pooled.conn
+            state.prepared = state.pooled.prepared
+        else:
+            state.conn = self._new_connection()
+            state.prepared = set()
+        state.cursor = self._new_cursor(state.conn)
+        return state.conn
+
+    def _close_cursor(self):
+        state = self._state
+        if state.cursor:
+            try:
+                state.cursor.close()
+            except self.dbexception:
+                pass
+            state.cursor = None
+
+    def disconnect(self):
+        state = self._state
+        self._close_cursor()
+        if state.pooled:
+            # something is wrong with the connection, don't reuse it
+            self.pool.put(state.pooled, discard=True)
+            state.pooled = None
+        elif state.conn:
+            state.conn.close()
+        state.conn = None
+        state.prepared = None
+
+    def release(self):
+        """
+        Return this threads connection to the pool, rolling back anything
+        not committed. Does nothing if the database is not pooled
+        """
+        state = self._state
+        if state.pooled is None:
+            return
+        self._close_cursor()
+        self.pool.put(state.pooled)
+        state.pooled = None
+        state.conn = None
+        state.prepared = None
 
     def begin(self):
         for i in range(0, 2):
@@ -128,6 +407,65 @@ class Database:
         """
         self.conn.rollback()
 
+    def in_transaction(self):
+        """
+        Returns True if inside a transaction() block
+        """
+        return self._state.txdepth > 0
+
+    def _autocommit(self, commit):
+        """
+        Commit after a single operation, unless inside a transaction() block
+        """
+        if commit and self._state.txdepth == 0:
+            self.commit()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run several operations as one transaction
+
+            with db.transaction():
+                db.insert(...)
+                db.update(...)
+
+        The commit each operation normally does is skipped, and there is one
+        commit when the outermost block ends. If the block raises an exception
+        everything is rolled back.
+        Nested blocks use savepoints, an exception in a nested block only
+        rolls back the changes done in that block
+        """
+        self.connect()
+        state = self._state
+        if state.txdepth == 0:
+            if self.driver == "sqlite" and not self.conn.in_transaction:
+                # otherwise the first savepoint starts, and its release ends, the transaction
+                self.cursor.execute("BEGIN")
+            state.txdepth = 1
+            try:
+                yield self
+            except BaseException:
+                state.txdepth = 0
+                if self.conn:
+                    self.rollback()
+                raise
+            state.txdepth = 0
+            self.commit()
+        else:
+            savepoint = f"savepoint_{state.txdepth}"
+            self.cursor.execute(f"SAVEPOINT {savepoint}")
+            state.txdepth += 1
+            try:
+                yield self
+            except BaseException:
+                state.txdepth -= 1
+                if self.conn:
+                    self.cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                    self.cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+                raise
+            state.txdepth -= 1
+            self.cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+
     def execute(self, sql, values=None):
         """
         Execute a query,
@@ -159,8 +497,7 @@ class Database:
     def count(self, sql, values=None, commit=True):
         self.execute(sql, values)
         row = self.cursor.fetchone()
-        if commit:
-            self.commit()
+        self._autocommit(commit)
         if row:
             if self.driver == "mysql":
                 return row["count(*)"]
@@ -170,27 +507,72 @@ class Database:
                 return row[0]
         return None
 
+    def _placeholders(self, count):
+        """
+        Placeholders for a PREPARE statement are numbered
+        """
+        return ",".join("$%d" % i for i in range(1, count + 1))
+
+    def _insert_statement(self, table, columns, primary_key):
+        def build(name):
+            if self.prepare:
+                tmp_values = self._placeholders(len(columns))
+            else:
+                tmp_values = ",".join([self.valueholder] * len(columns))
+                name = None
+            tmp_columns = ",".join(columns)
+            sql = f"INSERT into {table} ({tmp_columns}) VALUES ({tmp_values})"
+            if primary_key and self.driver == "psql":
+                sql += " RETURNING %s" % primary_key
+            return Statement(columns, sql, len(columns), name)
+        return self.statements.get(("insert", table, columns, primary_key, self.driver), build)
+
+    def _update_statement(self, table, columns, primary_key):
+        def build(name):
+            if self.prepare:
+                tmp_colname = ",".join("%s=$%d" % (colname, i) for i, colname in enumerate(columns, 1))
+                where = "$%d" % (len(columns) + 1)
+            else:
+                fstr = "{!s}=%s" % self.valueholder
+                tmp_colname = ",".join(fstr.format(colname) for colname in columns)
+                where = self.valueholder
+                name = None
+            sql = f"UPDATE {table} SET {tmp_colname}"
+            sql += f" WHERE {primary_key}={where}"
+            return Statement(columns, sql, len(columns) + 1, name)
+        return self.statements.get(("update", table, columns, primary_key, self.driver), build)
+
+    def _execute_statement(self, stmt, values):
+        """
+        Execute a cached statement. Prepared statements are created on
+        the connection the first time they are used on it
+        """
+        if stmt.name is None:
+            self.execute(stmt.sql, values)
+            return
+        self.connect()
+        prepared = self._state.prepared
+        if stmt.name not in prepared:
+            self.execute(f"PREPARE {stmt.name} AS {stmt.sql}")
+            prepared.add(stmt.name)
+        self.execute(stmt.execute_sql, values)
+
     def insert(self, table=None, d=None, primary_key="_id", exclude=None, commit=True):
         """
         Insert a row in a table, using table name and a dict
         Primary is the key, which should be updated with last_inserted_id
         exclude are columns that should be ignored
         """
-        if exclude is None:
-            exclude = []
-        exclude.append(primary_key)  # we always exclude the primary_key
-        columns = []
-        values = []
-        for colname in set(d.keys()) - set(exclude):
-            columns.append(colname)
-            values.append(d[colname])
-        tmp_columns = ",".join(columns)
-        tmp_values = ",".join([self.valueholder] * len(values))
-        sql = f"INSERT into {table} ({tmp_columns}) VALUES ({tmp_values})"
-        if primary_key and self.driver == "psql":
-            sql += " RETURNING %s" % primary_key
-
-        self.execute(sql, values)
+        exclude = set(exclude or [])
+        exclude.add(primary_key)  # we always exclude the primary_key
+        columns = tuple(sorted(colname for colname in d.keys() if colname not in exclude))
+        stmt = self._insert_statement(table, columns, primary_key)
+        values = [d[colname] for colname in columns]
+
+        self._execute_statement(stmt, values)
+        if not primary_key:
+            self._autocommit(commit)
+            return None
         if self.driver == "mysql":
             id_ = self.last_insert_id()
         elif self.driver == "psql":
@@ -198,8 +580,7 @@ class Database:
             id_ = res[primary_key]
         elif self.driver == "sqlite":
             id_ = self.cursor.lastrowid
-        if commit:
-            self.commit()
+        self._autocommit(commit)
         d[primary_key] = id_
         return id_
 
@@ -209,28 +590,231 @@ class Database:
         Primary is the key, which should be updated with last_inserted_id
         exclude are columns that should be ignored
         """
-        if exclude is None:
-            exclude = []
+        exclude = set(exclude or [])
         if primary_key:
-            exclude.append(primary_key)  # we always exclude the primary_key
-        columns = []
-        values = []
-        for colname in set(d.keys()) - set(exclude):
-            columns.append(colname)
-            values.append(d[colname])
-        fstr = "{!s}=%s" % self.valueholder
-        tmp_colname = ",".join(fstr.format(colname) for colname in columns)
-        sql = f"UPDATE {table} SET {tmp_colname}"
-        sql += f" WHERE {primary_key}={self.valueholder}"
+            exclude.add(primary_key)  # we always exclude the primary_key
+        columns = tuple(sorted(colname for colname in d.keys() if colname not in exclude))
+        stmt = self._update_statement(table, columns, primary_key)
+        values = [d[colname] for colname in columns]
         values.append(d[primary_key])
-        self.execute(sql, values)
-        if commit:
-            self.commit()
+        self._execute_statement(stmt, values)
+        self._autocommit(commit)
+
+    def _group_rows(self, rows, exclude):
+        """
+        Group rows on their set of columns, in a stable column order
+        Returns dict, columns -> list of (position in rows, row)
+        """
+        groups = collections.OrderedDict()
+        for ix, d in enumerate(rows):
+            columns = tuple(sorted(colname for colname in d.keys() if colname not in exclude))
+            groups.setdefault(columns, []).append((ix, d))
+        return groups
+
+    def _bulk_statement(self, table, columns, nrows, on_conflict="", returning=()):
+        """
+        Multi-row INSERT. For psql the VALUES are filled in by execute_values,
+        otherwise there are placeholders for nrows rows
+        """
+        def build(name):
+            tmp_columns = ",".join(columns)
+            if self.driver == "psql":
+                tmp_values = "%s"
+            else:
+                tmp_row = "(" + ",".join([self.valueholder] * len(columns)) + ")"
+                tmp_values = ",".join([tmp_row] * nrows)
+            sql = f"INSERT into {table} ({tmp_columns}) VALUES {tmp_values}{on_conflict}"
+            if returning:
+                sql += " RETURNING " + ",".join(returning)
+            return Statement(columns, sql, len(columns) * nrows)
+        key = ("insert_many", table, columns, nrows, on_conflict, returning, self.driver)
+        return self.statements.get(key, build)
+
+    def _returning(self):
+        """
+        True if INSERT ... RETURNING can be used
+        """
+        if self.driver == "psql":
+            return True
+        if self.driver == "sqlite":
+            import sqlite3
+            return sqlite3.sqlite_version_info >= (3, 35, 0)
+        return False
+
+    def _on_conflict(self, columns, conflict, primary_key):
+        """
+        Update existing rows. When all columns are in the conflict key there
+        is nothing to update, the first conflict column is set to itself so
+        the existing row still returns its key
+        """
+        update_columns = [colname for colname in columns if colname not in conflict]
+        if self.driver == "mysql":
+            # LAST_INSERT_ID(expr) makes lastrowid the key of the updated row
+            tmp_update = [f"{primary_key}=LAST_INSERT_ID({primary_key})"]
+            tmp_update += [f"{colname}=VALUES({colname})" for colname in update_columns]
+            return " ON DUPLICATE KEY UPDATE " + ",".join(tmp_update)
+        if not update_columns:
+            update_columns = conflict[:1]
+        tmp_update = ",".join(f"{colname}=excluded.{colname}" for colname in update_columns)
+        return f" ON CONFLICT ({','.join(conflict)}) DO UPDATE SET {tmp_update}"
+
+    def _insert_group(self, table, columns, group, primary_key, conflict=None):
+        """
+        Insert rows with the same columns, group is a list of (position, row)
+        If conflict is set existing rows are updated, and the returned keys
+        are matched to the rows on the conflict columns, otherwise on order
+        Returns list of primary keys, in same order as group
+        """
+        on_conflict = ""
+        returning = (primary_key,)
+        if conflict:
+            on_conflict = self._on_conflict(columns, conflict, primary_key)
+            returning += tuple(colname for colname in conflict if colname != primary_key)
+        argslist = [[d[colname] for colname in columns] for ix, d in group]
+
+        def match(res):
+            if not conflict:
+                return [row[primary_key] for row in res]
+            keys = {tuple(row[colname] for colname in conflict): row[primary_key] for row in res}
+            return [keys.get(tuple(d[colname] for colname in conflict)) for ix, d in group]
+
+        if self.driver == "psql":
+            import psycopg2.extras
+            stmt = self._bulk_statement(table, columns, 1, on_conflict, returning)
+            res = psycopg2.extras.execute_values(self.cursor, stmt.sql, argslist, page_size=1000, fetch=True)
+            return match(res)
+
+        size = max(1, self.BULK_MAX_PARAMS // max(1, len(columns)))
+        if self._returning():
+            # sqlite, one multi-row VALUES per chunk
+            res = []
+            for start in range(0, len(argslist), size):
+                chunk = argslist[start:start + size]
+                stmt = self._bulk_statement(table, columns, len(chunk), on_conflict, returning)
+                self.cursor.execute(stmt.sql, [value for args in chunk for value in args])
+                res += self.cursor.fetchall()
+            return match(res)
+
+        ids = []
+        if self.driver == "mysql" and not conflict:
+            # multi-row VALUES, the keys of a simple insert are consecutive from the first one
+            for start in range(0, len(argslist), size):
+                chunk = argslist[start:start + size]
+                stmt = self._bulk_statement(table, columns, len(chunk))
+                self.cursor.execute(stmt.sql, [value for args in chunk for value in args])
+                first = self.cursor.lastrowid
+                ids += list(range(first, first + len(chunk)))
+            return ids
+
+        # one row at a time, reading the key back
+        stmt = self._bulk_statement(table, columns, 1, on_conflict)
+        if conflict and self.driver == "sqlite":
+            # lastrowid is not set when an existing row was updated
+            where = " AND ".join(f"{colname}={self.valueholder}" for colname in conflict)
+            select = f"SELECT {primary_key} FROM {table} WHERE {where}"
+        for (ix, d), args in zip(group, argslist):
+            self.cursor.execute(stmt.sql, args)
+            if conflict and self.driver == "sqlite":
+                self.cursor.execute(select, [d[colname] for colname in conflict])
+                ids.append(self.cursor.fetchone()[0])
+            else:
+                ids.append(self.cursor.lastrowid)
+        return ids
+
+    def insert_many(self, table=None, rows=None, primary_key="_id", exclude=None, commit=True):
+        """
+        Insert a list of dicts in a table, in one transaction
+        Rows with the same columns are inserted together, with multi-row
+        VALUES, for psql with execute_values
+        Returns list of primary keys, in same order as rows. The primary
+        key is also updated in each dict
+        """
+        exclude = set(exclude or [])
+        exclude.add(primary_key)  # we always exclude the primary_key
+        ids = [None] * len(rows)
+        self.connect()
+        try:
+            for columns, group in self._group_rows(rows, exclude).items():
+                for (ix, d), id_ in zip(group, self._insert_group(table, columns, group, primary_key)):
+                    ids[ix] = id_
+            self._autocommit(commit)
+        except self.dbexception as err:
+            if not self.in_transaction():
+                self.rollback()
+            raise DbException(str(err))
+        for d, id_ in zip(rows, ids):
+            d[primary_key] = id_
+        return ids
+
+    def update_many(self, table=None, rows=None, primary_key="_id", exclude=None, commit=True):
+        """
+        Update a list of dicts in a table, in one transaction
+        Rows with the same columns are sent together, for psql with
+        execute_batch, otherwise with executemany
+        Rows with only the primary key have nothing to update and are skipped
+        """
+        exclude = set(exclude or [])
+        exclude.add(primary_key)  # we always exclude the primary_key
+        self.connect()
+        try:
+            for columns, group in self._group_rows(rows, exclude).items():
+                if not columns:
+                    continue
+                fstr = "{!s}=%s" % self.valueholder
+                tmp_colname = ",".join(fstr.format(colname) for colname in columns)
+                sql = f"UPDATE {table} SET {tmp_colname}"
+                sql += f" WHERE {primary_key}={self.valueholder}"
+                argslist = [[d[colname] for colname in columns] + [d[primary_key]] for ix, d in group]
+                if self.driver == "psql":
+                    import psycopg2.extras
+                    psycopg2.extras.execute_batch(self.cursor, sql, argslist)
+                else:
+                    self.cursor.executemany(sql, argslist)
+            self._autocommit(commit)
+        except self.dbexception as err:
+            if not self.in_transaction():
+                self.rollback()
+            raise DbException(str(err))
+        return len(rows)
+
+    def upsert_many(self, table=None, rows=None, primary_key="_id", conflict=None, exclude=None, commit=True):
+        """
+        Insert a list of dicts in a table, updating rows that already exist,
+        in one transaction
+
+        conflict is the list of columns with a unique constraint, used to
+        detect existing rows. Default is the primary key. Each row should
+        appear only once in rows, psql refuses to update a row twice in one
+        statement
+        Returns list of primary keys, in same order as rows. The primary
+        key is also updated in each dict
+        """
+        if conflict is None:
+            conflict = [primary_key]
+        exclude = set(exclude or [])
+        ids = [None] * len(rows)
+        self.connect()
+        try:
+            for columns, group in self._group_rows(rows, exclude).items():
+                if all(colname in columns for colname in conflict):
+                    group_ids = self._insert_group(table, columns, group, primary_key, conflict=conflict)
+                else:
+                    # conflict key is set by the database, the rows can only be new
+                    group_ids = self._insert_group(table, columns, group, primary_key)
+                for (ix, d), id_ in zip(group, group_ids):
+                    ids[ix] = id_
+            self._autocommit(commit)
+        except self.dbexception as err:
+            if not self.in_transaction():
+                self.rollback()
+            raise DbException(str(err))
+        for d, id_ in zip(rows, ids):
+            d[primary_key] = id_
+        return ids
 
     def delete(self, sql=None, values=None, commit=True):
         self.execute(sql, values)
-        if commit:
-            self.commit()
+        self._autocommit(commit)
         if self.driver == "mysql":
             pass
         elif self.driver == "psql":
@@ -245,20 +829,60 @@ class Database:
         """
         self.execute(sql, values)
         row = self.cursor.fetchone()
-        if commit:
-            self.commit()
+        self._autocommit(commit)
         if row:
             row = AttrDict(row)
         return row
 
+    def select_iter(self, sql=None, values=None, batch_size=1000, commit=True):
+        """
+        Returns an iterator over the result, each row as a dict
+
+        Rows are fetched batch_size at a time. For psql a server side (named)
+        cursor is used and for mysql an unbuffered cursor, so results of any
+        size are handled in constant memory.
+        Don't commit on this connection until the iterator is exhausted
+        or closed, committing closes the cursor
+        """
+        self.connect()
+        if self.driver == "psql":
+            import psycopg2.extras
+            name = "select_iter_%d" % next(_cursor_id)
+            cursor = self.conn.cursor(name=name, cursor_factory=psycopg2.extras.RealDictCursor)
+            cursor.itersize = batch_size
+        elif self.driver == "mysql":
+            import pymysql.cursors
+            cursor = self.conn.cursor(pymysql.cursors.SSDictCursor)
+        else:
+            cursor = self.conn.cursor()
+        try:
+            try:
+                if values:
+                    cursor.execute(sql, values)
+                else:
+                    cursor.execute(sql)
+            except self.dbexception as err:
+                raise DbException(str(err))
+            while True:
+                try:
+                    rows = cursor.fetchmany(batch_size)
+                except self.dbexception as err:
+                    raise DbException(str(err))
+                if not rows:
+                    break
+                for row in rows:
+                    yield AttrDict(row)
+        finally:
+            cursor.close()
+        self._autocommit(commit)
+
     def select_all(self, sql=None, values=None, commit=True):
         """
         Returns a list of dicts
         """
         self.execute(sql, values)
         rows = self.cursor.fetchall()
-        if commit:
-            self.commit()
+        self._autocommit(commit)
         for ix, row in enumerate(rows):
             rows[ix] = AttrDict(row)
         return rows
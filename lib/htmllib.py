@@ -25,8 +25,13 @@ class Htmllib:
     def __init__(self, db=None):
         self.db = db
 
-    def getUserCombo(self, name="userid", selected=None):
+    def getUserCombo(self, name="userid", selected=None, additional=None):
         s = f"<select name='{name}'>"
+        if selected:
+            selected = str(selected)
+        if additional:
+            for user in additional:
+                s += f"<option value='{user[0]}'>{user[1]}</option>"
         try:
             sql = "SELECT * FROM users ORDER BY name"
             data = self.db.select_all(sql)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Versioned schema migrations, for sqlite and PostgreSQL
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration:
+    """
+    One schema change
+
+    version      unique, migrations are applied in version order
+    description  stored in schema_version
+    sqlite, psql, mysql
+                 what to run for each driver, a list of sql statements or a
+                 function called with the Database. None means the change is
+                 not needed for that driver, it is only recorded as applied
+    """
+    def __init__(self, version, description, sqlite=None, psql=None, mysql=None):
+        self.version = version
+        self.description = description
+        self.steps = {"sqlite": sqlite, "psql": psql, "mysql": mysql}
+
+    def apply(self, db):
+        steps = self.steps[db.driver]
+        if steps is None:
+            return
+        if callable(steps):
+            steps(db)
+            return
+        for sql in steps:
+            db.execute(sql)
+
+
+class Migrator:
+    """
+    Apply migrations not yet recorded in the schema_version table
+
+    Each migration runs in its own transaction, together with the insert
+    into schema_version, so a failing migration leaves the database at
+    the previous version
+    """
+
+    table = "schema_version"
+
+    def __init__(self, db=None, migrations=None):
+        self.db = db
+        self.migrations = sorted(migrations or [], key=lambda m: m.version)
+        versions = [m.version for m in self.migrations]
+        if len(set(versions)) != len(versions):
+            raise MigrationError("Duplicate migration versions")
+
+    def create_schema(self):
+        sql = f"CREATE TABLE IF NOT EXISTS {self.table} ("
+        sql += "  version     INT       PRIMARY KEY, "
+        sql += "  description TEXT      NOT NULL default '', "
+        sql += "  applied     TIMESTAMP NOT NULL"
+        sql += ");"
+        self.db.execute(sql)
+        self.db.commit()
+
+    def current(self):
+        """
+        Returns highest applied version, 0 if none
+        """
+        row = self.db.select_one(f"SELECT MAX(version) AS version FROM {self.table}")
+        if row is None or row["version"] is None:
+            return 0
+        return row["version"]
+
+    def pending(self):
+        current = self.current()
+        return [m for m in self.migrations if m.version > current]
+
+    def _lock(self):
+        """
+        Serialize migrations run at the same time, for example from two
+        clients threads or two servers. Held until the transaction ends
+
+        sqlite: transaction() has already started a deferred transaction,
+        a write that changes nothing takes the write lock, as BEGIN IMMEDIATE
+        would. Call before anything is read in the transaction
+        """
+        if self.db.driver == "sqlite":
+            self.db.execute(f"UPDATE {self.table} SET version=version WHERE 0")
+        elif self.db.driver == "psql":
+            self.db.execute(f"LOCK TABLE {self.table} IN EXCLUSIVE MODE")
+        elif self.db.driver == "mysql":
+            self.db.execute(f"SELECT version FROM {self.table} FOR UPDATE")
+
+    def migrate(self, target=None, log=None):
+        """
+        Apply pending migrations, up to and including target if set
+        Returns list of applied migrations
+        """
+        self.create_schema()
+        applied = []
+        for migration in self.pending():
+            if target is not None and migration.version > target:
+                break
+            with self.db.transaction():
+                self._lock()
+                if self.current() >= migration.version:
+                    continue    # someone else applied it
+                if log:
+                    log.info(f"Migrate database to version {migration.version}, {migration.description}")
+                migration.apply(self.db)
+                self.db.insert(self.table, d={
+                    "version": migration.version,
+                    "description": migration.description,
+                    "applied": datetime.datetime.now(),
+                }, primary_key=None)
+            applied.append(migration)
+        return applied
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Daily rollup of reported time, maintained incrementally from report.seq
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+class DailyRollup:
+    """
+    Keep report_daily_rollup, reported time per user, activity and day, current
+
+    Every insert or update of a report gives it a new seq. The rollup remembers
+    the highest seq it has processed, and only reads reports above it.
+
+    report_rollup_applied holds what each report currently contributes to the
+    rollup. When a report changes its old contribution is subtracted and the new
+    one added, this handles reports moved to another day, activity or user, and
+    reports marked as deleted.
+
+    Note: a report written by a transaction that commits after a later seq has
+    been processed is missed. rebuild() recalculates everything from scratch.
+    """
+
+    name = "report_daily_rollup"
+
+    def __init__(self, db=None):
+        self.db = db
+
+    def create_schema(self):
+        """
+        Create the rollup tables, called from the server migrations
+        """
+        with self.db.transaction():
+            sql = "CREATE TABLE IF NOT EXISTS report_daily_rollup ("
+            sql += "  user_id       INT    NOT NULL, "
+            sql += "  activityid    INT    NOT NULL, "
+            sql += "  day           DATE   NOT NULL, "
+            sql += "  total_seconds BIGINT NOT NULL default 0, "
+            sql += "  count         INT    NOT NULL default 0, "
+            sql += "  PRIMARY KEY (user_id, activityid, day)"
+            sql += ");"
+            self.db.execute(sql)
+
+            sql = "CREATE TABLE IF NOT EXISTS report_rollup_applied ("
+            sql += "  report_id     INT    PRIMARY KEY, "
+            sql += "  user_id       INT    NOT NULL, "
+            sql += "  activityid    INT    NOT NULL, "
+            sql += "  day           DATE   NOT NULL, "
+            sql += "  seconds       BIGINT NOT NULL"
+            sql += ");"
+            self.db.execute(sql)
+
+            sql = "CREATE TABLE IF NOT EXISTS rollup_state ("
+            sql += "  name          TEXT   PRIMARY KEY, "
+            sql += "  seq           BIGINT NOT NULL default 0"
+            sql += ");"
+            self.db.execute(sql)
+
+            sql = "INSERT INTO rollup_state (name, seq) VALUES (%s, 0) ON CONFLICT DO NOTHING"
+            self.db.execute(sql, (self.name,))
+
+    def update(self, batch_size=1000):
+        """
+        Process next batch of changed reports, in one transaction
+        Returns number of processed reports
+        """
+        try:
+            # lock the watermark, so only one job at a time updates the rollup
+            sql = "SELECT seq FROM rollup_state WHERE name=%s FOR UPDATE"
+            row = self.db.select_one(sql, (self.name,), commit=False)
+            watermark = row.seq if row else 0
+
+            sql = "SELECT _id, seq FROM report WHERE seq > %s ORDER BY seq LIMIT %s"
+            rows = self.db.select_all(sql, (watermark, batch_size), commit=False)
+            if not rows:
+                self.db.commit()
+                return 0
+            ids = [row._id for row in rows]
+
+            # subtract what the reports contributed before they changed
+            sql = "UPDATE report_daily_rollup AS r"
+            sql += " SET total_seconds=r.total_seconds - a.seconds, count=r.count - a.count"
+            sql += " FROM (SELECT user_id, activityid, day, SUM(seconds) AS seconds, COUNT(*) AS count"
+            sql += "       FROM report_rollup_applied WHERE report_id = ANY(%s)"
+            sql += "       GROUP BY user_id, activityid, day) AS a"
+            sql += " WHERE r.user_id=a.user_id AND r.activityid=a.activityid AND r.day=a.day"
+            self.db.execute(sql, (ids,))
+
+            sql = "DELETE FROM report_daily_rollup AS r"
+            sql += " USING (SELECT DISTINCT user_id, activityid, day"
+            sql += "        FROM report_rollup_applied WHERE report_id = ANY(%s)) AS a"
+            sql += " WHERE r.user_id=a.user_id AND r.activityid=a.activityid AND r.day=a.day"
+            sql += " AND r.count <= 0"
+            self.db.execute(sql, (ids,))
+
+            sql = "DELETE FROM report_rollup_applied WHERE report_id = ANY(%s)"
+            self.db.execute(sql, (ids,))
+
+            # add what the reports contribute now, deleted reports contribute nothing
+            sql = "INSERT INTO report_rollup_applied (report_id, user_id, activityid, day, seconds)"
+            sql += " SELECT _id, user_id, activityid, start::date, EXTRACT(EPOCH FROM stop - start)::bigint"
+            sql += " FROM report WHERE _id = ANY(%s) AND deleted=0"
+            self.db.execute(sql, (ids,))
+
+            sql = "INSERT INTO report_daily_rollup (user_id, activityid, day, total_seconds, count)"
+            sql += " SELECT user_id, activityid, day, SUM(seconds), COUNT(*)"
+            sql += " FROM report_rollup_applied WHERE report_id = ANY(%s)"
+            sql += " GROUP BY user_id, activityid, day"
+            sql += " ON CONFLICT (user_id, activityid, day) DO UPDATE"
+            sql += " SET total_seconds=report_daily_rollup.total_seconds + EXCLUDED.total_seconds,"
+            sql += " count=report_daily_rollup.count + EXCLUDED.count"
+            self.db.execute(sql, (ids,))
+
+            sql = "UPDATE rollup_state SET seq=%s WHERE name=%s"
+            self.db.execute(sql, (rows[-1].seq, self.name))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return len(rows)
+
+    def run(self, batch_size=1000):
+        """
+        Process changed reports until the rollup is current
+        Returns number of processed reports
+        """
+        count = 0
+        while True:
+            processed = self.update(batch_size)
+            count += processed
+            if processed < batch_size:
+                return count
+
+    def rebuild(self, batch_size=1000):
+        """
+        Throw away the rollup and recalculate it from all reports
+        """
+        self.db.execute("TRUNCATE report_daily_rollup, report_rollup_applied")
+        self.db.execute("UPDATE rollup_state SET seq=0 WHERE name=%s", (self.name,))
+        self.db.commit()
+        return self.run(batch_size)
@@ -19,12 +19,17 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import io
+import gzip
 import datetime
 
 from flask import Flask, Response, request, redirect, render_template, flash, abort
 from flask.json import JSONEncoder
 from flask.ext.login import LoginManager, UserMixin, login_required, login_user, logout_user
 
+import lib.util as util     # read settings
+import lib.db as db
+
 
 class CustomJSONEncoder(JSONEncoder):
 
@@ -34,6 +39,35 @@ class CustomJSONEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 
+class GunzipRequest:
+    """
+    WSGI middleware, decompress request bodies sent with Content-Encoding: gzip
+    Responses are compressed by apache mod_deflate
+    """
+
+    max_size = 64 * 1024 * 1024     # refuse bodies larger than this when decompressed
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", "").lower() == "gzip":
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            try:
+                with gzip.GzipFile(fileobj=io.BytesIO(environ["wsgi.input"].read(length))) as f:
+                    body = f.read(self.max_size + 1)
+            except (OSError, EOFError):
+                start_response("400 Bad Request", [("Content-Type", "text/plain")])
+                return [b"Invalid gzip request body"]
+            if len(body) > self.max_size:
+                start_response("413 Request Entity Too Large", [("Content-Type", "text/plain")])
+                return [b"Request body too large"]
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.app(environ, start_response)
+
+
 server = Flask(
     __name__,
     static_url_path="/static",
@@ -41,11 +75,41 @@ server = Flask(
     template_folder="/opt/ergotime/server/views",
 )
 server.json_encoder = CustomJSONEncoder
+server.wsgi_app = GunzipRequest(server.wsgi_app)
 
 # Generate secret_key using the following command
 #   python3 -c 'import os; print(os.urandom(24))'
 server.secret_key = "ergotime 12343432434"
 
+
+def _checkPoolSize():
+    """
+    Without a pool all threads share one database connection, refuse to
+    start if mod_wsgi runs more than one thread per process
+    """
+    if config["db_conf"].get("pool_size", 0):
+        return
+    try:
+        import mod_wsgi
+        threads = mod_wsgi.threads_per_process
+    except (ImportError, AttributeError):
+        return      # not running in mod_wsgi
+    if threads > 1:
+        raise ValueError(f"db_conf pool_size must be at least 1 when mod_wsgi runs {threads} threads per process")
+
+
+_checkPoolSize()
+
+
+@server.teardown_request
+def release_db_connection(exc):
+    """
+    Return the database connection used by this request to the pool
+    """
+    if db.conn is not None:
+        db.conn.release()
+
+
 login_manager = LoginManager()
 login_manager.init_app(server)
 login_manager.login_view = "login"
@@ -28,19 +28,21 @@ import lib.util as util   # read settings
 import lib.db as db2
 import lib.htmllib
 
-db2.conn = db2.Database(config["db_conf"])
+if db2.conn is None:
+    # shared by all controllers, pooled if db_conf has a pool_size
+    db2.conn = db2.Database(config["db_conf"])
 
 htmllib = lib.htmllib.Htmllib(db2.conn)
 
 dateformat = '%Y-%m-%d'
 datetimeformat = dateformat + ' %H:%M:%S'
 
-errors = []
-
 
 @server.route("/activity/list")
 @login_required
 def activity_list():
-    errors.clear()
-    args = {}
+    errors = []
+    args = {
+        'errors': errors,
+    }
     return render_template('activity.html', **args)
@@ -19,32 +19,113 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
 import datetime
 from orderedattrdict import AttrDict
 
-from flask import request, jsonify, abort
+from flask import Response, request, jsonify, abort, stream_with_context
 from server import server
 
 import lib.db as db
 
+STREAM_BATCH_SIZE = 1000    # rows fetched from server side cursor, and sent, in each chunk
+
+
+def _wantStream():
+    """
+    Client asks for newline delimited json, with ?stream=1 or in Accept header
+    """
+    if request.args.get("stream", None):
+        return True
+    return "application/x-ndjson" in request.headers.get("Accept", "")
+
+
+def _streamRows(sql, values=None):
+    """
+    Send result of a query as newline delimited json, one row per line
+
+    Rows are read in chunks with select_iter(), so neither the database
+    driver or the response holds the whole result in memory
+    """
+    def generate():
+        lines = []
+        for row in db.conn.select_iter(sql, values, batch_size=STREAM_BATCH_SIZE):
+            lines.append(json.dumps(row, cls=server.json_encoder))
+            if len(lines) >= STREAM_BATCH_SIZE:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 # ----------------------------------------------------------------------
 #  Activities
 # ----------------------------------------------------------------------
 
 
+def _activityVersion():
+    """
+    Returns (highest seq, number of activities)
+    Any insert or update gives the activity a new seq, the count changes
+    if an activity is deleted
+    """
+    sql = "SELECT COALESCE(MAX(seq), 0) AS seq, COUNT(*) AS count FROM activity"
+    row = db.conn.select_one(sql)
+    return (row.seq, row.count)
+
+
+def _etagMatches(etag):
+    """
+    True if the client sent etag back in If-None-Match
+    Compared weakly, and without the -gzip suffix mod_deflate adds to
+    the ETag of compressed responses
+    """
+    if request.if_none_match.star_tag:
+        return True
+    for tag in request.if_none_match.as_set(include_weak=True):
+        if tag.endswith("-gzip"):
+            tag = tag[:-len("-gzip")]
+        if tag == etag:
+            return True
+    return False
+
+
 @server.route("/api/activity/<int:_id>")
 @server.route("/api/activity")
 def getActivity(_id=None):
+    """
+    The list is returned with an ETag. If the client sends it back in
+    If-None-Match and nothing has changed, 304 Not Modified is returned
+
+    ?since=<seq> only returns activities changed after seq. Use seq from
+    the response as since in the next request
+    """
     if _id:
         sql = "SELECT * FROM activity WHERE _id=%s"
         rows = db.conn.select_all(sql, (_id, ))
         if len(rows) > 0:
             return jsonify(rows[0])
         abort(404, {'message': 'Row with ID %s not found' % _id})
+
+    seq, count = _activityVersion()
+    etag = f"activity-{seq}-{count}"
+    if _etagMatches(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    since = request.args.get("since", None, type=int)
+    if since:
+        sql = "SELECT * FROM activity WHERE seq > %s ORDER BY seq"
+        rows = db.conn.select_all(sql, (since,))
     else:
         sql = "SELECT * FROM activity"
         rows = db.conn.select_all(sql)
-    return jsonify(data=rows)
+    response = jsonify(data=rows, seq=seq)
+    response.set_etag(etag)
+    return response
 
 
 @server.route("/api/activity", methods=["POST"])
@@ -67,11 +148,28 @@ def deleteActivity(_id):
 # ----------------------------------------------------------------------
 
 
-@server.route("/api/report/sync/<int:seq>")
-def syncReport(seq):
-    maxage = request.args.get("maxage", None)
-    limit = request.args.get("limit", None)
-    offset = request.args.get("offset", None)
+SYNC_PAGE_SIZE = 100        # default number of reports in each sync page
+SYNC_MAX_PAGE_SIZE = 1000   # upper limit, if client asks for larger pages
+
+
+def _page_size(limit):
+    """
+    Negotiate page size, clients may ask for a limit up to SYNC_MAX_PAGE_SIZE
+    A missing or invalid limit gives the default page size
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return SYNC_PAGE_SIZE
+    if not limit:
+        return SYNC_PAGE_SIZE
+    return max(1, min(limit, SYNC_MAX_PAGE_SIZE))
+
+
+def _report_changes_sql(seq, maxage=None):
+    """
+    Returns sql and values, for all reports changed after seq, ordered by seq
+    """
     sql = "SELECT * FROM report"
     where = []
     values = []
@@ -85,13 +183,114 @@ def syncReport(seq):
     if where:
         sql += " WHERE " + " AND ".join(where)
     sql += " ORDER BY seq"
-    if limit:
-        sql += " LIMIT %s" % limit
+    return sql, values
+
+
+def _report_changes(seq, maxage=None, limit=SYNC_PAGE_SIZE, offset=None):
+    """
+    Return one page of reports changed after seq, ordered by seq
+
+    Paging uses seq as cursor, the next page is requested with next_seq.
+    This uses the seq index and does not scan already returned rows, and
+    a report updated during sync gets a new seq and shows up on a later page
+
+    Returns (rows, next_seq, has_more)
+    """
+    sql, values = _report_changes_sql(seq, maxage)
+    sql += " LIMIT %s" % (limit + 1)    # one extra, to find out if there are more rows
     if offset:
-        sql += " OFFSET %s" % offset
-    print(sql, values)
+        # Deprecated, only used by older clients that page with offset
+        sql += " OFFSET %s" % int(offset)
     rows = db.conn.select_all(sql, values)
-    return jsonify(data=rows)
+
+    has_more = len(rows) > limit
+    if has_more:
+        del rows[limit:]
+    if rows:
+        next_seq = rows[-1].seq
+    else:
+        next_seq = seq
+    return rows, next_seq, has_more
+
+
+@server.route("/api/report/sync/<int:seq>")
+def syncReport(seq):
+    """
+    Return reports changed after seq, one page at a time
+    Follow next_seq as long as has_more is true
+
+    If streamed, all reports changed after seq are returned as
+    newline delimited json, and there is no paging
+    """
+    maxage = request.args.get("maxage", None, type=int)
+    if _wantStream():
+        sql, values = _report_changes_sql(seq, maxage)
+        return _streamRows(sql, values)
+    limit = _page_size(request.args.get("limit", None, type=int))
+    offset = request.args.get("offset", None, type=int)
+    rows, next_seq, has_more = _report_changes(seq, maxage, limit, offset)
+    return jsonify(data=rows, next_seq=next_seq, has_more=has_more, limit=limit)
+
+
+# Columns a client may set on a report, everything else is owned by the server
+report_columns = ["user_id", "activityid", "start", "stop", "comment", "modified", "deleted"]
+
+
+def _report_from_client(data):
+    report = AttrDict()
+    for col in report_columns:
+        if col in data:
+            report[col] = data[col]
+    return report
+
+
+@server.route("/api/report/sync", methods=["POST"])
+def batchSyncReport():
+    """
+    Apply all local changes from a client in one transaction, and return
+    everything changed on the server since the clients seq
+
+    Request
+      seq       highest seq the client has seen
+      maxage    optional, only return reports modified in the last maxage days
+      create    list of new reports, _id is the clients local _id
+      update    list of changed reports, server_id is the _id on the server
+      delete    list of server _id, for reports that should be marked deleted
+      limit     optional, page size for the returned reports
+
+    Response
+      created   list of {_id: local _id, server_id: _id on server}
+      data      first page of reports with seq > the clients seq, including the ones just stored
+      next_seq  cursor, request the next page with /api/report/sync/<next_seq>
+      has_more  true if there are more pages
+      limit     page size used by the server
+    """
+    data = AttrDict(request.get_json(force=True))
+    seq = int(data.get("seq", 0))
+    created = []
+    try:
+        for report in data.get("create", []):
+            row = _report_from_client(report)
+            server_id = db.conn.insert("report", d=row, primary_key="_id", commit=False)
+            created.append({"_id": report["_id"], "server_id": server_id})
+
+        for report in data.get("update", []):
+            row = _report_from_client(report)
+            row._id = report["server_id"]
+            db.conn.update("report", d=row, primary_key="_id", commit=False)
+
+        delete = data.get("delete", [])
+        if delete:
+            sql = "UPDATE report SET deleted=1 WHERE _id = ANY(%s)"
+            db.conn.execute(sql, (list(delete), ))
+        db.conn.commit()
+    except db.DbException as err:
+        db.conn.rollback()
+        abort(500, {'message': "Can't store reports, %s" % err})
+
+    limit = _page_size(data.get("limit", None))
+    rows, next_seq, has_more = _report_changes(seq, data.get("maxage", None), limit)
+    return jsonify(created=created, data=rows, next_seq=next_seq, has_more=has_more, limit=limit)
 
 
 @server.route("/api/report/<int:_id>")
@@ -105,6 +304,8 @@ def getReport(_id=None):
         abort(404, {'message': 'Row with ID %s not found' % _id})
     else:
         sql = "SELECT * FROM report"
+        if _wantStream():
+            return _streamRows(sql)
         rows = db.conn.select_all(sql)
     return jsonify(data=rows)
 
@@ -155,6 +356,8 @@ def getUser(_id=None):
         abort(404, {'message': 'Row with ID %s not found' % _id})
     else:
         sql = "SELECT * FROM users"
+        if _wantStream():
+            return _streamRows(sql)
         rows = db.conn.select_all(sql)
     return jsonify(data=rows)
 
@@ -23,35 +23,27 @@ from flask import render_template, request
 from server import server
 
 import datetime
+import threading
+import collections
 from orderedattrdict import AttrDict
 
 import lib.log as log
 import lib.util as util     # read settings
 import lib.db as db2
 import lib.htmllib
+import lib.aggregate
 
-db2.conn = db2.Database(config["db_conf"])
+if db2.conn is None:
+    # shared by all controllers, pooled if db_conf has a pool_size
+    db2.conn = db2.Database(config["db_conf"])
 
 htmllib = lib.htmllib.Htmllib(db2.conn)
+# report_rollup: true, if ergotime_rollup.py keeps report_daily_rollup current
+aggregate = lib.aggregate.ReportAggregate(db2.conn, rollup=config.get("report_rollup", False))
 
 dateformat = '%Y-%m-%d'
 datetimeformat = dateformat + ' %H:%M:%S'
 
-errors = []
-
-
-def strTimedeltaHM(td, includeDecimal=False):
-    """
-    Convert a timedelta to hours and minutes
-    """
-    seconds = td.total_seconds()
-    hours = seconds / 3600
-    minutes = (seconds / 60) % 60
-    res = "%02i:%02i" % (hours, minutes)
-    if includeDecimal:
-        res += "\n(%i.%02i)" % (hours, minutes * 100 / 60)
-    return res
-
 
 class MyDateTime:
 
@@ -173,7 +165,7 @@ class ReportRes:
         self.comment = comment.strip()
 
     def strLength(self):
-        return strTimedeltaHM(self.length)
+        return lib.aggregate.strSeconds(self.length.total_seconds())
 
 
 class ActivityDay:
@@ -188,7 +180,7 @@ class ActivityDay:
         self.total += report.length
 
     def strTotal(self, includeDecimal=False):
-        return strTimedeltaHM(self.total, includeDecimal=includeDecimal)
+        return lib.aggregate.strSeconds(self.total.total_seconds(), includeDecimal=includeDecimal)
 
     # go through all reports, return dict with values
     # If non-first entry, return empty date
@@ -211,7 +203,7 @@ class ActivityMonth:
         self.total += day.total
 
     def strTotal(self, includeDecimal=False):
-        return strTimedeltaHM(self.total, includeDecimal=includeDecimal)
+        return lib.aggregate.strSeconds(self.total.total_seconds(), includeDecimal=includeDecimal)
 
 
 class Activities:
@@ -224,7 +216,7 @@ class Activities:
         self.total += activity.total
 
     def strTotal(self):
-        return strTimedeltaHM(self.total)
+        return lib.aggregate.strSeconds(self.total.total_seconds())
 
 
 def sectotime(sec):
@@ -294,71 +286,140 @@ def getLastDayInMonth(d, offset=0):
     return d.strftime(dateformat)
 
 
-def addActivity(activity=None,
-                userid=None,
-                start=None,
-                debug=None):
-    """
-    Add reports for the specified activity and month
+class ReportCache:
     """
-    lastday = [0, 0, 0]
-    activityDay = None
+    LRU cache of built monthly reports
 
-    if activity.description:
-        tmp = activity.description
-    else:
-        tmp = activity.name
+    Each entry is stored with a version, from monthVersion(). An entry is
+    only used if the version is unchanged, so a repeated view costs one
+    query instead of loading and grouping all reports
+    """
+    def __init__(self, size=128, maxage=3600):
+        self.size = size
+        self.maxage = maxage    # seconds, entries are rebuilt after this
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            created, entry_version, activities = entry
+            if entry_version != version or datetime.datetime.now() - created > datetime.timedelta(seconds=self.maxage):
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return activities
+
+    def put(self, key, version, activities):
+        with self._lock:
+            self._cache[key] = (datetime.datetime.now(), version, activities)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+
+reportCache = ReportCache(size=config.get("report_cache_size", 128),
+                          maxage=config.get("report_cache_maxage", 3600))
+
+
+def monthVersion(userid=None, start=None):
+    """
+    Returns a version for all reports for a user and month
 
+    Any insert or update of a report gives it a new seq. Deleted reports are
+    included, they are only marked as deleted and get a new seq. A report
+    moved to another month lowers the count
+    """
     stop = start.copy()
     stop.setFirstDayInMonth(1)
     stop.addTime(seconds=-1)
 
-    activityMonth = ActivityMonth(start, stop, description=tmp)
+    sql = "SELECT MAX(seq) AS seq, COUNT(*) AS count FROM report WHERE"
+    sql += " user_id=%s AND start>=%s AND start<=%s"
+    row = db2.conn.select_one(sql, (userid, str(start.obj), str(stop.obj)))
+    return (row.seq, row.count)
+
+
+def loadActivities(activities=None,
+                   userid=None,
+                   activityid=None,
+                   start=None,
+                   debug=None):
+    """
+    Add reports for the specified month, grouped per activity and day
+
+    All reports are fetched with one query, sorted so each activity and
+    each day within the activity arrives as one consecutive run of rows
+    Only activities with reports are added
+    """
+    stop = start.copy()
+    stop.setFirstDayInMonth(1)
+    stop.addTime(seconds=-1)
 
     values = []
-    sql = "SELECT * FROM report WHERE"
-    sql += " user_id=%s AND"
+    sql = "SELECT report.*, activity.name AS activity_name, activity.description AS activity_description"
+    sql += " FROM report JOIN activity ON activity._id=report.activityid WHERE"
+    sql += " report.user_id=%s AND"
     values.append(userid)
 
-    sql += " activityid=%s AND"
-    values.append(activity._id)
+    if activityid is not None and activityid > 0:
+        sql += " report.activityid=%s AND"
+        values.append(activityid)
 
-    sql += " start>=%s AND"
+    sql += " report.start>=%s AND"
     values.append(str(start.obj))
-    
-    sql += " start<=%s AND"
+
+    sql += " report.start<=%s AND"
     values.append(str(stop.obj))
 
-    sql += " deleted=0"
-    sql += " ORDER BY start"
-    try:
-        data = db2.conn.select_all(sql, values)
-        for report in data:
-            # new day?
-            if lastday != [report.start.year, report.start.month, report.start.day]:
-                if activityDay:
-                    activityMonth.addDay(activityDay)
-                activityDay = ActivityDay(report.start.date())
-                lastday = [report.start.year, report.start.month, report.start.day]
-
-            comment = report.comment
-            if debug is not None:
-                comment += " (%s)" % report._id
-
-            rep = ReportRes(report.start, report.stop, comment)
-            activityDay.addReport(rep)
-
-        if activityDay is not None:
-            activityMonth.addDay(activityDay)
-    except db2.DbException as err:
-        errors.append("db.Error %s" % err)
+    sql += " report.deleted=0"
+    sql += " ORDER BY activity.name, activity._id, report.start"
 
-    return activityMonth
+    data = db2.conn.select_iter(sql, values)
+
+    lastactivityid = None
+    lastday = None
+    activityMonth = None
+    activityDay = None
+    for report in data:
+        # new activity?
+        if report.activityid != lastactivityid:
+            if activityMonth is not None:
+                activityMonth.addDay(activityDay)
+                activities.addActivity(activityMonth)
+            if report.activity_description:
+                tmp = report.activity_description
+            else:
+                tmp = report.activity_name
+            activityMonth = ActivityMonth(start, stop, description=tmp)
+            activityDay = None
+            lastactivityid = report.activityid
+            lastday = None
+
+        # new day?
+        if lastday != report.start.date():
+            if activityDay is not None:
+                activityMonth.addDay(activityDay)
+            activityDay = ActivityDay(report.start.date())
+            lastday = report.start.date()
+
+        comment = report.comment
+        if debug is not None:
+            comment += " (%s)" % report._id
+
+        rep = ReportRes(report.start, report.stop, comment)
+        activityDay.addReport(rep)
+
+    if activityMonth is not None:
+        activityMonth.addDay(activityDay)
+        activities.addActivity(activityMonth)
 
 
 @server.route("/reports/monthly")
 def reports_monthly():
-    errors.clear()
+    errors = []
     p = AttrDict()
     activities = Activities()
 
@@ -435,27 +496,22 @@ def reports_monthly():
     elif p.activityid is None:
         errors.append("Please specifiy activity")
     else:
-        sql = "SELECT * FROM activity"
-        values = []
-
-        if p.activityid > 0:
-            sql += " WHERE _id=%s"
-            values.append(p.activityid)
-
-        sql += " ORDER BY name"
         try:
-            activitylist = db2.conn.select_all(sql, values)
-            for activity in activitylist:
-                activityMonth = addActivity(
-                    activity=activity,
+            key = (p.userid, p.activityid, p.dstart.strYM(), p.debug)
+            version = monthVersion(userid=p.userid, start=p.dstart)
+            cached = reportCache.get(key, version)
+            if cached is not None:
+                activities = cached
+            else:
+                loadActivities(
+                    activities=activities,
                     userid=p.userid,
+                    activityid=p.activityid,
                     start=p.dstart,
                     debug=p.debug)
-                if len(activityMonth.days) > 0:
-                    activities.addActivity(activityMonth)
-
+                reportCache.put(key, version, activities)
         except db2.DbException as err:
-            errors.append("Can't load list of activities %s", err)
+            errors.append("Can't load reports %s" % err)
 
     log.debug("p.dstart 2  %s" % p.dstart)
     log.debug("p.prevstart %s" % p.prevstart)
@@ -469,3 +525,57 @@ def reports_monthly():
         'htmllib': htmllib,
     }
     return render_template('reports.html', **args)
+
+
+@server.route("/reports/totals")
+def reports_totals():
+    """
+    Reported time for a year, summed per period, activity and/or user
+    The sums are calculated by the database
+    """
+    errors = []
+    p = AttrDict()
+
+    # parameters, in url
+    p.userid = request.args.get("userid", -1, type=int)
+    p.activityid = request.args.get("activityid", -1, type=int)
+    p.year = request.args.get("year", datetime.datetime.now().year, type=int)
+    p.period = request.args.get("period", "month")
+    p.group = request.args.get("group", "activity")
+
+    # unknown values are ignored, the template only shows columns that are grouped on
+    if p.period not in aggregate.periods:
+        p.period = ""
+    if p.group not in ["activity", "user"]:
+        p.group = ""
+
+    group_by = []
+    if p.period:
+        group_by.append(p.period)
+    if p.group:
+        group_by.append(p.group)
+
+    userids = None
+    if p.userid > 0:
+        userids = [p.userid]
+    activityids = None
+    if p.activityid > 0:
+        activityids = [p.activityid]
+
+    totals = lib.aggregate.Totals(group_by)
+    try:
+        start = datetime.datetime(p.year, 1, 1)
+        stop = datetime.datetime(p.year + 1, 1, 1)
+        totals = aggregate.totals(start, stop, group_by, userids=userids, activityids=activityids)
+    except ValueError as err:
+        errors.append("Incorrect year %s" % err)
+    except db2.DbException as err:
+        errors.append("Can't load totals %s" % err)
+
+    args = {
+        'errors': errors,
+        'totals': totals,
+        'p': p,
+        'htmllib': htmllib,
+    }
+    return render_template('totals.html', **args)
@@ -29,7 +29,9 @@ import lib.util as util     # read config file
 import lib.log as log
 import lib.db as db
 
-db.conn = db.Database(config["db_conf"], driver="psql")
+if db.conn is None:
+    # shared by all controllers, pooled if db_conf has a pool_size
+    db.conn = db.Database(config["db_conf"], driver="psql")
 
 table_defs = util.yaml_load("%s/table_crud.yaml" % config["etcdir"])
 
@@ -166,24 +168,27 @@ def table_crud_api(table):
     elif cmd == "save-records":
         # save all changes from datagrid, can be multiple rows
         print("save-records", data)
+        rows = []
         for values in data.changes:
             values[primary_key] = values.pop("recid")
-            try:
-                db.conn.update(table=table, d=values, primary_key=primary_key)
-                res.status = 'success'
-            except db.conn.dbexception as e:
-                set_error(res, str(e))
-                break
+            rows.append(values)
+        try:
+            db.conn.update_many(table=table, rows=rows, primary_key=primary_key)
+            res.status = 'success'
+        except db.DbException as e:
+            set_error(res, str(e))
 
     elif cmd == "delete-records":
         # print("delete-records", data)
-        for selected in data.selected:
-            try:
-                sql = "DELETE FROM %s WHERE %s=%%s" % (table, primary_key)
-                db.conn.delete(sql, (selected,))
-                res.status = 'success'
-            except db.conn.dbexception as e:
-                set_error(res, str(e))
+        # all selected rows are deleted, or none of them
+        sql = "DELETE FROM %s WHERE %s=%%s" % (table, primary_key)
+        try:
+            with db.conn.transaction():
+                for selected in data.selected:
+                    db.conn.delete(sql, (selected,))
+            res.status = 'success'
+        except db.DbException as e:
+            set_error(res, str(e))
 
     else:
         set_error(res, "Unknown cmd from w2ui grid %s" % cmd)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Create or upgrade the server database schema
+
+Run after installing a new version, before starting the server
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lib.util as util     # read settings
+import lib.log as log
+import lib.db as db
+import lib.migrate
+
+import migrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create or upgrade the database schema")
+    parser.add_argument("--list", action="store_true", help="Show current version and pending migrations")
+    parser.add_argument("--target", type=int, default=None, help="Only migrate up to this version")
+    args = parser.parse_args()
+
+    conn = db.Database(util.config["db_conf"])
+    migrator = lib.migrate.Migrator(conn, migrations.migrations)
+
+    try:
+        if args.list:
+            migrator.create_schema()
+            print(f"Current version {migrator.current()}")
+            for migration in migrator.pending():
+                print(f"  pending {migration.version:4d} {migration.description}")
+            return
+
+        applied = migrator.migrate(target=args.target, log=log)
+        log.info(f"Applied {len(applied)} migrations, database is at version {migrator.current()}")
+    except db.DbException as err:
+        log.error(f"Migration failed {err}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
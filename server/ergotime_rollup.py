@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Keep the report_daily_rollup table current
+
+Run from cron, or with --interval to keep running
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lib.util as util     # read settings
+import lib.log as log
+import lib.db as db
+import lib.rollup
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update report_daily_rollup from changed reports")
+    parser.add_argument("--create", action="store_true", help="Create the rollup tables")
+    parser.add_argument("--rebuild", action="store_true", help="Recalculate the rollup from all reports")
+    parser.add_argument("--batch", type=int, default=1000, help="Number of reports in each transaction")
+    parser.add_argument("--interval", type=int, default=0, help="Keep running, update every interval seconds")
+    args = parser.parse_args()
+
+    conn = db.Database(util.config["db_conf"])
+    rollup = lib.rollup.DailyRollup(conn)
+
+    if args.create:
+        rollup.create_schema()
+    if args.rebuild:
+        count = rollup.rebuild(args.batch)
+        log.info(f"Rollup rebuilt from {count} reports")
+
+    while True:
+        try:
+            count = rollup.run(args.batch)
+            if count:
+                log.info(f"Rollup updated with {count} changed reports")
+        except db.DbException as err:
+            log.error(f"Can't update rollup {err}")
+            conn.disconnect()
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
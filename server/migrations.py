@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Schema migrations for the server database
+
+Only add new migrations to the end of the list, with a higher version.
+Existing installations already have the tables and the seq trigger, so
+the first migrations must be safe to run on them
+
+Copyright (C) 2020 Anders Lowinger, anders@abundo.se
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from lib.migrate import Migration
+import lib.rollup
+
+
+def _create_tables(db):
+    sql = "CREATE TABLE IF NOT EXISTS users ("
+    sql += "  _id         SERIAL PRIMARY KEY, "
+    sql += "  name        TEXT    NOT NULL default '', "
+    sql += "  password    TEXT    NOT NULL default '', "
+    sql += "  active      BOOLEAN NOT NULL default true"
+    sql += ");"
+    db.execute(sql)
+
+    sql = "CREATE TABLE IF NOT EXISTS activity ("
+    sql += "  _id         SERIAL PRIMARY KEY, "
+    sql += "  name        TEXT    NOT NULL default '', "
+    sql += "  description TEXT    NOT NULL default '', "
+    sql += "  project_id  INT     NOT NULL default -1, "
+    sql += "  active      BOOLEAN NOT NULL default false, "
+    sql += "  server_id   INT     NOT NULL default -1"
+    sql += ");"
+    db.execute(sql)
+
+    sql = "CREATE TABLE IF NOT EXISTS project ("
+    sql += "  _id         SERIAL PRIMARY KEY, "
+    sql += "  activityid  INT     NOT NULL default -1, "
+    sql += "  name        TEXT    NOT NULL default '', "
+    sql += "  costcenter  TEXT    NOT NULL default '', "
+    sql += "  active      BOOLEAN NOT NULL default false"
+    sql += ");"
+    db.execute(sql)
+
+    sql = "CREATE TABLE IF NOT EXISTS report ("
+    sql += "  _id         SERIAL PRIMARY KEY, "
+    sql += "  user_id     INT       NOT NULL default -1, "
+    sql += "  activityid  INT       NOT NULL default -1, "
+    sql += "  start       TIMESTAMP NOT NULL, "
+    sql += "  stop        TIMESTAMP NOT NULL, "
+    sql += "  comment     TEXT      NOT NULL default '', "
+    sql += "  modified    TIMESTAMP NOT NULL default now(), "
+    sql += "  seq         BIGINT    NOT NULL default 0, "
+    sql += "  deleted     INT       NOT NULL default 0"
+    sql += ");"
+    db.execute(sql)
+
+
+def _create_report_seq(db):
+    """
+    Any insert or update of a report gives it a new seq. This is what
+    client sync, the monthly report cache and the rollup use to find
+    changed reports
+    """
+    db.execute("CREATE SEQUENCE IF NOT EXISTS report_seq")
+
+    sql = "CREATE OR REPLACE FUNCTION update_modified_seq()"
+    sql += " RETURNS trigger AS $$"
+    sql += " BEGIN"
+    sql += "    new.seq = nextval('report_seq');"
+    sql += "    RETURN new;"
+    sql += " END;"
+    sql += " $$ LANGUAGE plpgsql"
+    db.execute(sql)
+
+    db.execute("UPDATE report SET seq=0 WHERE seq IS NULL")
+    db.execute("DROP TRIGGER IF EXISTS insert_customer_seq ON report")
+    db.execute("DROP TRIGGER IF EXISTS update_customer_seq ON report")
+    sql = "CREATE TRIGGER insert_customer_seq BEFORE INSERT ON report"
+    sql += " FOR EACH ROW EXECUTE PROCEDURE update_modified_seq()"
+    db.execute(sql)
+    sql = "CREATE TRIGGER update_customer_seq BEFORE UPDATE ON report"
+    sql += " FOR EACH ROW EXECUTE PROCEDURE update_modified_seq()"
+    db.execute(sql)
+
+
+def _create_activity_seq(db):
+    """
+    Same as for reports, any insert or update of an activity gives it a new
+    seq, so clients can fetch only changed activities
+    """
+    db.execute("ALTER TABLE activity ADD COLUMN IF NOT EXISTS seq BIGINT NOT NULL default 0")
+    db.execute("CREATE SEQUENCE IF NOT EXISTS activity_seq")
+
+    sql = "CREATE OR REPLACE FUNCTION update_activity_seq()"
+    sql += " RETURNS trigger AS $$"
+    sql += " BEGIN"
+    sql += "    new.seq = nextval('activity_seq');"
+    sql += "    RETURN new;"
+    sql += " END;"
+    sql += " $$ LANGUAGE plpgsql"
+    db.execute(sql)
+
+    db.execute("DROP TRIGGER IF EXISTS activity_seq ON activity")
+    sql = "CREATE TRIGGER activity_seq BEFORE INSERT OR UPDATE ON activity"
+    sql += " FOR EACH ROW EXECUTE PROCEDURE update_activity_seq()"
+    db.execute(sql)
+
+    db.execute("UPDATE activity SET seq=0")    # trigger gives all existing rows a seq
+    db.execute("CREATE INDEX IF NOT EXISTS activity_seq_idx ON activity (seq)")
+
+
+def _create_rollup(db):
+    lib.rollup.DailyRollup(db).create_schema()
+
+
+migrations = [
+    Migration(1, "Create tables", psql=_create_tables),
+
+    Migration(2, "Report seq trigger", psql=_create_report_seq),
+
+    Migration(3, "Indexes for sync and reports", psql=[
+        "CREATE INDEX IF NOT EXISTS report_seq_idx ON report (seq)",
+        "CREATE INDEX IF NOT EXISTS report_user_id_start_idx ON report (user_id, start)",
+    ]),
+
+    Migration(4, "Daily rollup tables", psql=_create_rollup),
+
+    Migration(5, "Activity seq trigger", psql=_create_activity_seq),
+]